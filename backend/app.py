@@ -1,4 +1,4 @@
-from flask import Flask, send_file, jsonify, request
+from flask import Flask, send_file, jsonify, request, Response
 from flask_cors import CORS
 import socket  # Get local IP address
 import os
@@ -6,25 +6,20 @@ import qrcode
 import io
 import base64
 import subprocess
+import queue
 # my modules
 import configuration
 import processing
 import jobs
-import recorder
 import aruco
+import events
+import streaming
 
 # Flask setup
 app = Flask(__name__)
 app.secret_key = 'secret'
 cors = CORS(app, resources={r"/api/*": {"origins": "*"}})
 
-config = configuration.Configuration()
-preview = processing.Preview(config)
-job_manager = jobs.JobManager(config, preview)
-video_recorder = recorder.VideoRecorder(config)
-
-is_recording = False # nasty global variable
-
 # Remind the user to go to the frontend if they go to the backend
 @app.route('/api')
 def index():
@@ -36,28 +31,20 @@ def toggle_recording():
 
     new_recording_status = request.get_json()['recording_status'] # Determine whether to start or stop recording
 
-    global is_recording
+    # Already recording and asked to start, or not recording and asked to stop (something went wrong)
+    if new_recording_status == job_manager.recording:
+        return jsonify({'status': "error", 'recording_status': job_manager.recording})
 
-    if not is_recording:
-        # if not recording and request to start recording
-        if new_recording_status:
+    if new_recording_status:
+        try:
             job_manager.start_recording()
-            is_recording = True
-        # if not recording and request to stop recording (something went wrong)
-        if not new_recording_status:
-            return jsonify({'status': "error", 'recording_status': is_recording})
-
-    if is_recording:
-        # if recording and request to stop recording
-        if not new_recording_status:
-            is_recording = False
-            job_manager.stop_recording()
-
-        # if recording and request to start recording (something went wrong)
-        if new_recording_status:
-            return jsonify({'status': "error", 'recording_status': is_recording})
-    
-    return jsonify({'status': "success", 'recording_status': is_recording})
+        except Exception as e:
+            print(f"Failed to start recording: {e}")
+            return jsonify({'status': "error", 'recording_status': job_manager.recording})
+    else:
+        job_manager.stop_recording()
+
+    return jsonify({'status': "success", 'recording_status': job_manager.recording})
 
 # Download recording video (if exists)
 @app.route('/api/download_recording', methods=['GET'])
@@ -108,8 +95,12 @@ def get_ip():
 # Returns whether or not the backend is recording
 @app.route('/api/recording_status', methods=['GET'])
 def recording_status():
-    global is_recording
-    return jsonify({'recording_status': is_recording})
+    return jsonify({'recording_status': job_manager.recording})
+
+# Returns how well the recording processes are keeping up with the cameras
+@app.route('/api/recording_health', methods=['GET'])
+def recording_health():
+    return jsonify({'recording_status': job_manager.recording, 'processes': job_manager.video_recorder.get_health()})
 
 # Returns the current settings
 @app.route('/api/settings', methods=['GET','POST'])
@@ -133,9 +124,8 @@ def settings():
 def capture_frame():
     video_device = request.get_json()['video_device']
     global preview
-    # focus the camera
-    global video_recorder
-    video_recorder.focus_camera(video_device)
+    # focus the camera, only written when the settings changed
+    job_manager.video_recorder.camera_controls.apply([video_device])
     frame_jpeg = processing.convert_to_jpeg(preview.capture_frame(video_device))
     return "data:image/jpg;base64," + base64.b64encode(frame_jpeg).decode('utf-8')
 
@@ -165,6 +155,7 @@ def corners():
 
         config.config[video_device]['corners'] = corners
         config.save_config()
+        processing.clear_warper_cache(video_device)
 
         return jsonify({'status': "success"})
 
@@ -184,6 +175,18 @@ def preview_warped():
     frame_jpeg = processing.convert_to_jpeg(preview.warp_frame(video_device))
     return "data:image/jpg;base64," + base64.b64encode(frame_jpeg).decode('utf-8')
 
+# Streams the raw or warped view of a video device continuously as MJPEG, for an <img> or background image
+@app.route('/api/preview_stream/<video_device>/<view>', methods=['GET'])
+def preview_stream(video_device, view):
+    global config
+    global preview_streams
+    if video_device not in ['video0', 'video1']:
+        return jsonify({'status': "error", 'message': "Invalid video_device"})
+    if view not in ['raw', 'warped']:
+        return jsonify({'status': "error", 'message': "view must be raw or warped"})
+    stream = preview_streams.get_stream(video_device, view)
+    return Response(stream.stream(), mimetype=f'multipart/x-mixed-replace; boundary={streaming.BOUNDARY}', headers={'Cache-Control': 'no-cache'})
+
 @app.route('/api/jobs', methods=['GET', 'POST'])
 def jobs_route():
     global job_manager
@@ -196,9 +199,11 @@ def jobs_route():
         match data['action']:
             case 'run':
                 job_manager.run_job(data['job_name'])
+                job_manager.publish_jobs()
                 return jsonify({'status': "success"})
             case 'remove':
                 job_manager.remove_job(data['job_name'])
+                job_manager.publish_jobs()
                 return jsonify({'status': "success"})
             case 'download':
                 global config
@@ -206,11 +211,34 @@ def jobs_route():
                 return send_file(output_file, as_attachment=True)
             case 'run_all':
                 job_manager.run_jobs()
+                job_manager.publish_jobs()
                 return jsonify({'status': "success"})
             case 'clear_finished':
                 job_manager.clear_finished_jobs()
+                job_manager.publish_jobs()
                 return jsonify({'status': "success"})
 
+# Streams job and recording status updates as Server-Sent Events
+@app.route('/api/events', methods=['GET'])
+def events_route():
+    global job_manager
+    subscriber = job_manager.events.subscribe()
+
+    def stream():
+        try:
+            # Start with the current state so the page doesn't need to fetch it separately
+            yield events.format_event('recording_status', {'recording_status': job_manager.recording})
+            yield events.format_event('jobs', job_manager.get_all_jobs())
+            while True:
+                try:
+                    yield subscriber.get(timeout=15)
+                except queue.Empty:
+                    yield ": keepalive\n\n" # comment line that keeps proxies from closing the connection
+        finally:
+            job_manager.events.unsubscribe(subscriber)
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/api/purge_recordings_directory', methods=['POST'])
 def purge_recordings():
     global job_manager
@@ -269,4 +297,13 @@ def preview_aruco_corners():
     return "data:image/jpg;base64," + base64.b64encode(frame_jpeg).decode('utf-8')
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    debug = True
+    # In debug mode the reloader runs this file again in a child process that serves the requests, while this one
+    # only watches for changes. Only the serving process opens the cameras and resumes jobs, so they aren't processed twice.
+    # Processes started by multiprocessing don't run this either, since they import this file under another name.
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        config = configuration.Configuration()
+        preview = processing.Preview(config)
+        job_manager = jobs.JobManager(config, preview)
+        preview_streams = streaming.PreviewStreams(config, preview)
+    app.run(debug=debug, host='0.0.0.0', port=5000)
\ No newline at end of file
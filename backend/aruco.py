@@ -1,6 +1,7 @@
 import cv2
 import numpy as np
 import configuration
+import processing
 
 # ArUco marker layout
 # 0               1    4                5
@@ -10,6 +11,13 @@ import configuration
 #  |____________|        |____________|
 # 2               3    6                7
 
+# Marker detectors for each set of detector parameters, see get_detector
+_detectors = {}
+
+# Index of the outer corner of the marker in each corner of a whiteboard, in the order of the bounding box
+# corners returned by detectMarkers (clockwise from the top left)
+OUTER_CORNERS = [0, 1, 3, 2]
+
 def set_video_corners(video_device: str, frame: cv2.typing.MatLike, config: configuration.Configuration) -> cv2.typing.MatLike:
     """
     Sets the corners of the video device based on the ArUco markers in the frame. Allows for automatic recalibration
@@ -25,7 +33,7 @@ def set_video_corners(video_device: str, frame: cv2.typing.MatLike, config: conf
     # print(f"Setting corners for {video_device}")
     debug_frame = frame.copy()
 
-    boundingBoxes, ids = get_markers(frame)
+    boundingBoxes, ids = get_markers(frame, config, expected=4) # a whiteboard has a marker in each corner
     # print(f"Found {len(ids)} markers from {video_device}")
     # print(f"Found marker ids: {ids}")
 
@@ -40,10 +48,12 @@ def set_video_corners(video_device: str, frame: cv2.typing.MatLike, config: conf
     if 0 in boundingBoxesDict and 1 in boundingBoxesDict and 2 in boundingBoxesDict and 3 in boundingBoxesDict: # left
         # print("Found left whiteboard markers")
         config.config["stack_order"] = [1, 0]
+        config.config[video_device]['marker_ids'] = [0, 1, 2, 3]
         corners = [get_bounding_box_corners(boundingBoxesDict[i]) for i in range(0,4)]
     elif 4 in boundingBoxesDict and 5 in boundingBoxesDict and 6 in boundingBoxesDict and 7 in boundingBoxesDict: # right
         # print("Found right whiteboard markers")
         config.config["stack_order"] = [0, 1]
+        config.config[video_device]['marker_ids'] = [4, 5, 6, 7]
         corners = [get_bounding_box_corners(boundingBoxesDict[i]) for i in range(4,8)]
     else:
         # print(f"Invalid marker ids: {ids}")
@@ -52,10 +62,11 @@ def set_video_corners(video_device: str, frame: cv2.typing.MatLike, config: conf
     # get the outer corners of the markers
     # 0a 0b
     # 0c 0d    we want 0a, 1b, 2c, and 3d
-    outer_corners = [corners[0][0], corners[1][1], corners[2][3], corners[3][2]]
+    outer_corners = [corners[i][OUTER_CORNERS[i]] for i in range(4)]
     config.config[video_device]['corners'] = outer_corners
 
     config.save_config()
+    processing.clear_warper_cache(video_device)
 
     # draw the outer corners
     for i, outer_corner in enumerate(outer_corners):
@@ -64,16 +75,177 @@ def set_video_corners(video_device: str, frame: cv2.typing.MatLike, config: conf
 
     return debug_frame
 
-def get_markers(frame):
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+def get_markers(frame, config: configuration.Configuration, scale: float = None, expected: int = 1):
+    """
+    Detects the ArUco markers in a frame. The markers are found in a scaled down copy of the frame, then
+    their corners are refined to subpixel accuracy in the full resolution frame.
+
+    Args:
+        frame (numpy.ndarray): The frame to detect the markers in, in color or grayscale.
+        config (configuration.Configuration): The configuration to take the detector settings from.
+        scale (float, optional): The scale to detect the markers at, instead of the configured detection_scale. Defaults to None.
+        expected (int, optional): How many markers should be found, fewer are looked for again at full resolution. Defaults to 1.
+
+    Returns:
+        tuple: The bounding boxes of the markers, each an array of shape (1, 4, 2), and the marker ids, an array of shape (N, 1) or None.
+    """
+    gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    aruco_config = config.config['aruco']
+    if scale is None:
+        scale = aruco_config['detection_scale']
+
+    detect = get_detector(aruco_config['parameters'])
+    boundingBoxes, ids = None, None
+    if scale < 1:
+        small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        boundingBoxes, ids = detect(small)
+        if ids is not None:
+            boundingBoxes = [boundingBox / scale for boundingBox in boundingBoxes]
+    if ids is None or len(ids) < expected: # small markers can get lost when scaled down
+        fullBoundingBoxes, fullIds = detect(gray)
+        if fullIds is not None and (ids is None or len(fullIds) > len(ids)):
+            boundingBoxes, ids = fullBoundingBoxes, fullIds
+    if ids is None:
+        return (), None
+    ids = ids.reshape(-1, 1) # newer OpenCV versions return a flat array
 
-    arucoDict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_4X4_50)
-    boundingBoxes, ids, rejected = cv2.aruco.detectMarkers(gray, arucoDict)
+    # Refine the corners in the full resolution frame
+    window = int(aruco_config['refine_window'])
+    if window > 0:
+        corners = np.concatenate(boundingBoxes).reshape(-1, 1, 2).astype(np.float32)
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+        corners = cv2.cornerSubPix(gray, corners, (window, window), (-1, -1), criteria)
+        boundingBoxes = list(corners.reshape(-1, 1, 4, 2))
 
     return boundingBoxes, ids
 
+def get_detector(parameters: dict):
+    """
+    Returns a function that detects markers in a grayscale image with the given detector parameters.
+    Detectors are cached, since building the dictionary and parameters for every frame adds up.
+
+    Args:
+        parameters (dict): Names and values of cv2.aruco.DetectorParameters attributes to change from their defaults.
+
+    Returns:
+        function: Takes a grayscale image and returns the bounding boxes and ids of the markers in it.
+    """
+    key = tuple(sorted(parameters.items()))
+    if key not in _detectors:
+        dictionary = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_4X4_50)
+        # OpenCV 4.7 replaced the detection functions with the ArucoDetector class
+        detector_parameters = cv2.aruco.DetectorParameters() if hasattr(cv2.aruco, 'DetectorParameters') else cv2.aruco.DetectorParameters_create()
+        for name, value in parameters.items():
+            setattr(detector_parameters, name, value)
+
+        if hasattr(cv2.aruco, 'ArucoDetector'):
+            detector = cv2.aruco.ArucoDetector(dictionary, detector_parameters)
+            def detect(gray):
+                boundingBoxes, ids, rejected = detector.detectMarkers(gray)
+                return boundingBoxes, ids
+        else:
+            def detect(gray):
+                boundingBoxes, ids, rejected = cv2.aruco.detectMarkers(gray, dictionary, parameters=detector_parameters)
+                return boundingBoxes, ids
+        _detectors[key] = detect
+    return _detectors[key]
+
 def get_bounding_box_corners(boundingBox):
     corners = []
     for corner in boundingBox[0]:
         corners.append((int(corner[0]), int(corner[1])))
-    return corners
\ No newline at end of file
+    return corners
+
+class CornerTracker():
+    def __init__(self, corners: list, config: configuration.Configuration, search_size: float = 0.25, scale: float = 0.5, smoothing: float = 0.5, threshold: float = 4,
+                 marker_ids: list = None):
+        """
+        Follows the ArUco markers on the corners of a whiteboard through a recording, so the warp can be corrected
+        if the camera gets bumped. Markers are only searched for in small regions around where they were last seen.
+
+        Args:
+            corners (list): The corners of the whiteboard to start from, in the order of the corners config.
+            config (configuration.Configuration): The configuration to take the detector settings from.
+            search_size (float, optional): The size of the square searched around each corner, as a fraction of the frame width. Defaults to 0.25.
+            scale (float, optional): How much the search regions are scaled down before detecting markers in them. Defaults to 0.5.
+            smoothing (float, optional): How much of the previous position is kept each time a marker is found, from 0 to 1,
+                so the corners don't jitter with every detection. Defaults to 0.5.
+            threshold (float, optional): How many pixels a corner has to move before the corners are updated. Defaults to 4.
+            marker_ids (list, optional): The ids of the markers on the corners, in the order of the corners config. Defaults to None
+                to take them from the first marker found near its corner.
+        """
+        self.corners = np.array(corners, dtype=np.float32) # the corners the warp is currently built from
+        self.smoothed_corners = self.corners.copy()
+        self.search_size = search_size
+        self.scale = scale
+        self.smoothing = smoothing
+        self.threshold = threshold
+        self.config = config
+        self.marker_ids = list(marker_ids) if marker_ids else None
+
+    def update(self, frame: np.ndarray) -> bool:
+        """
+        Looks for the markers in the frame and moves the corners towards them.
+
+        Args:
+            frame (numpy.ndarray): The frame from the camera
+
+        Returns:
+            bool: True if the corners moved by more than the threshold, in which case the warp needs rebuilding.
+        """
+        found_corners = self.find_corners(frame)
+        for i, corner in enumerate(found_corners):
+            if corner is not None:
+                self.smoothed_corners[i] = self.smoothing * self.smoothed_corners[i] + (1 - self.smoothing) * corner
+
+        if np.max(np.linalg.norm(self.smoothed_corners - self.corners, axis=1)) > self.threshold:
+            self.corners = self.smoothed_corners.copy()
+            return True
+        return False
+
+    def find_corners(self, frame: np.ndarray) -> list:
+        """Returns the position of each corner's marker in the frame, or None for markers that weren't found"""
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        frame_height, frame_width = gray.shape
+        half_size = int(self.search_size * frame_width / 2)
+
+        found_corners = [None] * 4
+        for i, (x, y) in enumerate(self.smoothed_corners):
+            # The outer corner is at the edge of the marker, so the marker itself is towards the middle of the whiteboard
+            left, top = max(int(x) - half_size, 0), max(int(y) - half_size, 0)
+            right, bottom = min(int(x) + half_size, frame_width), min(int(y) + half_size, frame_height)
+            if right - left < 8 or bottom - top < 8:
+                continue
+            bounding_boxes, ids = get_markers(gray[top:bottom, left:right], self.config, self.scale)
+            found_corners[i] = self.select_corner(bounding_boxes, ids, i, (left, top), (x, y))
+
+        # The camera moved too far for the markers to still be in their regions, so look at the whole frame,
+        # detecting the markers once for all four corners since this is slow. The other whiteboard can be in view too,
+        # so this needs to know which markers are this whiteboard's
+        if all(corner is None for corner in found_corners) and self.marker_ids is not None:
+            bounding_boxes, ids = get_markers(gray, self.config, self.scale)
+            found_corners = [self.select_corner(bounding_boxes, ids, i, (0, 0), self.smoothed_corners[i]) for i in range(4)]
+        return found_corners
+
+    def select_corner(self, bounding_boxes, ids, corner_index: int, offset: tuple, last_position: tuple):
+        """Returns the outer corner of the marker for the given whiteboard corner among the detected markers, nearest to its
+        last position, or None if it isn't there"""
+        if ids is None:
+            return None
+
+        candidates = []
+        for bounding_box, marker_id in zip(bounding_boxes, ids.flatten()):
+            if self.marker_ids is not None:
+                if marker_id != self.marker_ids[corner_index]:
+                    continue
+            elif marker_id >= 8 or marker_id % 4 != corner_index: # markers 0-3 and 4-7 are in the same corners of their whiteboards
+                continue
+            corner = bounding_box[0][OUTER_CORNERS[corner_index]] + offset
+            candidates.append((corner, marker_id))
+        if not candidates:
+            return None
+        corner, marker_id = min(candidates, key=lambda candidate: np.linalg.norm(candidate[0] - last_position))
+        if self.marker_ids is None:
+            # A marker found near where its corner was is on this whiteboard, so only follow that whiteboard's markers from now on
+            self.marker_ids = [int(marker_id) - int(marker_id) % 4 + i for i in range(4)]
+        return corner
@@ -2,7 +2,7 @@ import numpy as np
 import cv2
 import os
 
-def generate_marker(id: int, size: int = 4, borderBits: int = 1, whiteBorderBits: int = 0):
+def generate_marker(id: int, size: int = 4, borderBits: int = 1, whiteBorderBits: int = 0, save: bool = True, show: bool = True) -> np.ndarray:
     """
     Generate an ArUco marker, optionally with a white border around the marker.
 
@@ -11,6 +11,11 @@ def generate_marker(id: int, size: int = 4, borderBits: int = 1, whiteBorderBits
         size (int, optional): The size of the marker. Defaults to 4 pixels.
         borderBits (int, optional): The number of border bits. Defaults to 1.
         whiteBorderBits (int, optional): The number of white border bits, around the black border. Defaults to 0.
+        save (bool, optional): Save the marker to the markers directory. Defaults to True.
+        show (bool, optional): Show the marker in a window until a key is pressed. Defaults to True.
+
+    Returns:
+        numpy.ndarray: The grayscale marker image.
     """
     total_size = size + (2*borderBits) + (2*whiteBorderBits)
     aruco_dict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_4X4_50)
@@ -25,13 +30,17 @@ def generate_marker(id: int, size: int = 4, borderBits: int = 1, whiteBorderBits
         marker[-whiteBorderPixels:, :] = 255
         marker[:, -whiteBorderPixels:] = 255
 
-    file_path = f"markers\\ArUco_4x4_50_{id}.png"
-    if not os.path.exists("markers"):
-        os.makedirs("markers")
+    if save:
+        file_path = os.path.join("markers", f"ArUco_4x4_50_{id}.png")
+        if not os.path.exists("markers"):
+            os.makedirs("markers")
+        cv2.imwrite(file_path, marker)
+
+    if show:
+        cv2.imshow("ArUco marker", marker)
+        cv2.waitKey(0)
 
-    cv2.imwrite(file_path, marker)
-    cv2.imshow("ArUco marker", marker)
-    cv2.waitKey(0)
+    return marker
 
 if __name__ == "__main__":
     print("Generating ArUco markers. Press any key to generate the next marker.")
@@ -0,0 +1,236 @@
+import argparse
+import json
+import multiprocessing
+import os
+import pathlib
+import queue
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+import cv2
+import numpy as np
+# my modules
+import arucogen
+import configuration
+import processing
+
+# Benchmarks processing on synthetic whiteboard footage, so throughput can be compared between pipelines,
+# encoding profiles and computers without recording a real lecture. Runs headless:
+#   python3 benchmark.py --resolution 1920x1080 --duration 30 --pipelines pipe,segmented --profiles whiteboard,fast
+
+# Processing steps run for each pipeline, the same as jobs.ProcessingJob without copying the output
+PIPELINE_STAGES = {
+    'pipe': ['process_recording_piped'],
+    'segmented': ['process_recording_segmented'],
+    'files': ['process_recording', 'stack_processed_videos'],
+}
+
+# Where the corners of the whiteboard end up in the camera frame, as fractions of the frame size
+BOARD_CORNERS = [(0.12, 0.10), (0.90, 0.16), (0.06, 0.92), (0.95, 0.85)]
+
+def generate_whiteboard_video(output_file: str, resolution: tuple = (1280, 720), fps: float = 30, duration: float = 10, noise: int = 2, seed: int = 0) -> list:
+    """
+    Generates a recording of a whiteboard seen at an angle, with ArUco markers in its corners and pen
+    strokes that are drawn in bursts and occasionally erased, like a lecture. The video is encoded as
+    mjpeg with a test tone for audio, the same as a recording from a webcam.
+
+    Args:
+        output_file (str): The path of the video file to write, should be an mkv file.
+        resolution (tuple, optional): The (width, height) of the video. Defaults to (1280, 720).
+        fps (float, optional): The framerate of the video. Defaults to 30.
+        duration (float, optional): The length of the video in seconds. Defaults to 10.
+        noise (int, optional): The amount of sensor noise to add to each frame, 0 for none. Defaults to 2.
+        seed (int, optional): The random seed, so the same video is generated every time. Defaults to 0.
+
+    Returns:
+        list: The corners of the whiteboard in the video, in the order used by the corners config.
+    """
+    rng = np.random.default_rng(seed)
+    width, height = resolution
+
+    # Draw the whiteboard with markers 0-3 in its corners, like the left whiteboard
+    board = np.full((height, width, 3), 235, dtype=np.uint8)
+    marker_size = max(height // 8, 16)
+    markers = [arucogen.generate_marker(id=i, size=marker_size, borderBits=1, whiteBorderBits=1, save=False, show=False) for i in range(4)]
+    marker_total_size = markers[0].shape[0]
+    white_border = int(np.argmax(markers[0].reshape(marker_total_size, marker_total_size).min(axis=1) < 128)) # rows before the black border
+    for i, (x, y) in enumerate([(0, 0), (width - marker_total_size, 0), (0, height - marker_total_size), (width - marker_total_size, height - marker_total_size)]):
+        board[y:y + marker_total_size, x:x + marker_total_size] = cv2.cvtColor(markers[i], cv2.COLOR_GRAY2BGR)
+
+    # Outer corners of the black borders of the markers, which is what aruco.set_video_corners finds
+    board_corners = np.array([[white_border, white_border], [width - white_border, white_border],
+                              [white_border, height - white_border], [width - white_border, height - white_border]], dtype="float32")
+    source_corners = np.array([[0, 0], [width, 0], [0, height], [width, height]], dtype="float32")
+    frame_corners = np.array([[x * width, y * height] for x, y in BOARD_CORNERS], dtype="float32")
+    transform_matrix = cv2.getPerspectiveTransform(source_corners, frame_corners)
+    corners = cv2.perspectiveTransform(board_corners.reshape(-1, 1, 2), transform_matrix).reshape(-1, 2)
+
+    # A few noise patterns are reused, generating new noise for every frame would dominate the run time
+    noise_frames = [rng.integers(0, noise + 1, (height, width, 3), dtype=np.uint8) for i in range(8)] if noise > 0 else []
+
+    ffmpeg_process = subprocess.Popen(['ffmpeg','-hide_banner','-loglevel','error','-y',
+                                       '-f','rawvideo','-pix_fmt','bgr24','-s',f"{width}x{height}",'-r',str(fps),'-i','pipe:0',
+                                       '-f','lavfi','-i',f"sine=frequency=440:sample_rate=48000:duration={duration}",
+                                       '-map','0:v','-map','1:a','-codec:v','mjpeg','-q:v','3','-codec:a','aac',
+                                       '-shortest',output_file], stdin=subprocess.PIPE)
+
+    pen = np.array([width / 2, height / 2])
+    drawing = False
+    frames_until_switch = 0
+    for frame_index in range(round(duration * fps)):
+        # Alternate between writing for a while and pausing, so some frames are unchanged
+        if frames_until_switch <= 0:
+            drawing = not drawing
+            frames_until_switch = int(rng.uniform(1, 3) * fps)
+            pen = np.array([rng.uniform(0.15, 0.85) * width, rng.uniform(0.15, 0.85) * height])
+        frames_until_switch -= 1
+
+        if drawing:
+            for i in range(3):
+                next_pen = np.clip(pen + rng.normal(0, height / 60, 2), marker_total_size, [width - marker_total_size, height - marker_total_size])
+                cv2.line(board, tuple(int(v) for v in pen), tuple(int(v) for v in next_pen), (120, 40, 20), max(height // 300, 2), cv2.LINE_AA)
+                pen = next_pen
+        elif rng.random() < 0.01:
+            # Erase part of the board
+            x, y = int(rng.uniform(0.2, 0.6) * width), int(rng.uniform(0.2, 0.6) * height)
+            cv2.rectangle(board, (x, y), (x + width // 4, y + height // 4), (235, 235, 235), -1)
+
+        frame = cv2.warpPerspective(board, transform_matrix, (width, height), borderValue=(70, 60, 50))
+        if noise_frames:
+            cv2.add(frame, noise_frames[frame_index % len(noise_frames)], dst=frame)
+        ffmpeg_process.stdin.write(frame.tobytes())
+
+    ffmpeg_process.stdin.close()
+    if ffmpeg_process.wait() != 0:
+        raise Exception(f"ffmpeg failed to write {output_file}")
+
+    return [[round(float(x)), round(float(y))] for x, y in corners]
+
+def run_benchmark(config: configuration.Configuration, video_file: str, corners: list, pipeline: str, profile: str, recording_directory: pathlib.Path) -> dict:
+    """
+    Processes the video with one pipeline and encoding profile, and measures how long it took and the
+    resources it used. Run this in a fresh process so that the CPU time and peak memory are its own.
+
+    Args:
+        config (configuration.Configuration): The configuration to benchmark, it is not saved.
+        video_file (str): The generated whiteboard video to process.
+        corners (list): The corners of the whiteboard in the video.
+        pipeline (str): The processing pipeline, either 'pipe', 'segmented' or 'files'.
+        profile (str): The encoding profile, one of processing.ENCODING_PROFILES.
+        recording_directory (pathlib.Path): An empty directory to process the recording in.
+
+    Returns:
+        dict: The results of the benchmark.
+    """
+    video = cv2.VideoCapture(video_file)
+    resolution = [int(video.get(cv2.CAP_PROP_FRAME_WIDTH)), int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))]
+    framerate = video.get(cv2.CAP_PROP_FPS)
+    video.release()
+
+    # Process the video as a recording from a single camera
+    config.config['video0'].update({'enabled': True, 'corners': corners, 'resolution': resolution, 'framerate': framerate})
+    config.config['video1']['enabled'] = False
+    config.config['processing']['pipeline'] = pipeline
+    config.config['encoding']['profile'] = profile
+    recording_directory.mkdir(parents=True, exist_ok=True)
+    shutil.copy(video_file, recording_directory.joinpath(config.config['video0']['temp_video_file']))
+
+    video_processing = processing.Processing(config, recording_directory, 'benchmark')
+    output_fps, frame_count = video_processing.get_output_timing()
+
+    start_time = time.time()
+    stage_times = {}
+    for stage in PIPELINE_STAGES[pipeline]:
+        stage_start_time = time.time()
+        getattr(video_processing, stage)()
+        stage_times[stage] = round(time.time() - stage_start_time, 2)
+    elapsed = time.time() - start_time
+
+    # ffmpeg and the segment workers are child processes, so their usage is counted separately
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    output_file = recording_directory.joinpath('benchmark.mp4')
+
+    return {
+        'pipeline': pipeline,
+        'profile': profile,
+        'frames': frame_count,
+        'seconds': round(elapsed, 2),
+        'fps': round(frame_count / elapsed, 2),
+        'realtime': round(frame_count / output_fps / elapsed, 2),
+        'cpu_seconds': round(usage.ru_utime + usage.ru_stime, 2),
+        'children_cpu_seconds': round(children_usage.ru_utime + children_usage.ru_stime, 2),
+        'peak_rss_mb': round(usage.ru_maxrss / 1024, 1), # ru_maxrss is in kilobytes on Linux
+        'children_peak_rss_mb': round(children_usage.ru_maxrss / 1024, 1), # of the largest child, not the total
+        'output_mb': round(os.path.getsize(output_file) / 1024 / 1024, 2),
+        'stage_times': stage_times,
+    }
+
+def _run_benchmark(results: multiprocessing.Queue, *args):
+    """Entry point of the process running a single benchmark"""
+    try:
+        results.put(run_benchmark(*args))
+    except Exception as e:
+        results.put({'pipeline': args[3], 'profile': args[4], 'error': str(e)})
+
+def print_results(results: list[dict]):
+    """Prints the results of the benchmarks as a table"""
+    columns = ['pipeline', 'profile', 'frames', 'seconds', 'fps', 'realtime', 'cpu_seconds', 'children_cpu_seconds', 'peak_rss_mb', 'children_peak_rss_mb', 'output_mb']
+    rows = [[str(result.get(column, '')) for column in columns] for result in results]
+    widths = [max(len(column), *(len(row[i]) for row in rows)) for i, column in enumerate(columns)]
+    print('  '.join(column.ljust(widths[i]) for i, column in enumerate(columns)))
+    for row, result in zip(rows, results):
+        if 'error' in result:
+            print(f"{row[0].ljust(widths[0])}  {row[1].ljust(widths[1])}  failed: {result['error']}")
+        else:
+            print('  '.join(value.ljust(widths[i]) for i, value in enumerate(row)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark processing on synthetic whiteboard footage")
+    parser.add_argument('--resolution', default='1280x720', help="Resolution of the generated video. Defaults to 1280x720.")
+    parser.add_argument('--fps', type=float, default=30, help="Framerate of the generated video. Defaults to 30.")
+    parser.add_argument('--duration', type=float, default=10, help="Length of the generated video in seconds. Defaults to 10.")
+    parser.add_argument('--noise', type=int, default=2, help="Sensor noise added to the generated video, 0 for none. Defaults to 2.")
+    parser.add_argument('--pipelines', default=','.join(PIPELINE_STAGES), help="Comma separated pipelines to benchmark. Defaults to all of them.")
+    parser.add_argument('--profiles', default='whiteboard,fast', help="Comma separated encoding profiles to benchmark. Defaults to whiteboard,fast.")
+    parser.add_argument('--directory', help="Directory to work in, kept afterwards. Defaults to a temporary directory.")
+    parser.add_argument('--json', help="Also write the results to this JSON file.")
+    args = parser.parse_args()
+
+    config = configuration.Configuration()
+    resolution = tuple(int(v) for v in args.resolution.lower().split('x'))
+    directory = pathlib.Path(args.directory) if args.directory else pathlib.Path(tempfile.mkdtemp(prefix='whiteboard_benchmark_'))
+    directory.mkdir(parents=True, exist_ok=True)
+
+    print(f"Generating {args.duration} seconds of {args.resolution} video at {args.fps} fps")
+    video_file = directory.joinpath('whiteboard.mkv').as_posix()
+    corners = generate_whiteboard_video(video_file, resolution, args.fps, args.duration, args.noise)
+
+    # Each benchmark runs in its own process, so memory use and CPU time don't carry over between them
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for pipeline in args.pipelines.split(','):
+        for profile in args.profiles.split(','):
+            print(f"Benchmarking the {pipeline} pipeline with the {profile} profile")
+            result_queue = context.Queue()
+            process = context.Process(target=_run_benchmark, args=(result_queue, config, video_file, corners, pipeline, profile, directory.joinpath(f"{pipeline}_{profile}")))
+            process.start()
+            result = None
+            while result is None:
+                try:
+                    result = result_queue.get(timeout=1)
+                except queue.Empty:
+                    if not process.is_alive(): # crashed without reporting back
+                        result = {'pipeline': pipeline, 'profile': profile, 'error': f"exit code {process.exitcode}"}
+            process.join()
+            results.append(result)
+
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=4)
+
+    if not args.directory:
+        shutil.rmtree(directory)
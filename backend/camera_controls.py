@@ -0,0 +1,131 @@
+import os
+import re
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# Names each control has had in v4l2, newest first, since older kernels use the old names
+CONTROL_NAMES = {
+    'focus_automatic_continuous': ['focus_automatic_continuous', 'focus_auto'],
+    'focus_absolute': ['focus_absolute'],
+    'auto_exposure': ['auto_exposure', 'exposure_auto'],
+    'exposure_time_absolute': ['exposure_time_absolute', 'exposure_absolute'],
+    'white_balance_automatic': ['white_balance_automatic', 'white_balance_temperature_auto'],
+    'white_balance_temperature': ['white_balance_temperature'],
+}
+
+# Matches a control and its current value in the output of v4l2-ctl --list-ctrls, such as
+# "focus_absolute 0x009a090a (int)    : min=0 max=255 step=5 default=0 value=30 flags=inactive"
+CONTROL_PATTERN = re.compile(r'^\s*(\w+) 0x[0-9a-f]+ \(\w+\)\s*:.*?\bvalue=(-?\d+)', re.MULTILINE)
+
+class CameraControls():
+    def __init__(self, config):
+        """Applies the focus, exposure and white balance from the config to the cameras through v4l2-ctl.
+        The controls each camera supports and their values are read every time they are applied, since a camera
+        can be replugged or changed by another program, and only the controls whose value differs are written,
+        in as few v4l2-ctl calls as possible and for all the cameras at the same time.
+        Only works on linux right now because of the v4l2-ctl command
+
+        Args:
+            config (configuration.Configuration): The configuration
+        """
+        self.config = config
+
+    def get_controls(self, video_device: str) -> list[dict]:
+        """Returns the v4l2 controls to set on the video device, in two steps: the automatic modes first,
+        then the values that can only be set once the automatic mode is off
+
+        Args:
+            video_device (str): The internal name of the video device (either video0 or video1)
+        """
+        video_device_config = self.config.config[video_device]
+        modes = {}
+        values = {}
+
+        # Enable autofocus if necessary
+        if int(video_device_config['focus']) == -1:
+            modes['focus_automatic_continuous'] = 1
+        else:
+            modes['focus_automatic_continuous'] = 0
+            values['focus_absolute'] = int(video_device_config['focus'])
+
+        # 3 is aperture priority mode, where the camera picks the exposure time, and 1 is manual mode
+        if int(video_device_config['exposure']) == -1:
+            modes['auto_exposure'] = 3
+        else:
+            modes['auto_exposure'] = 1
+            values['exposure_time_absolute'] = int(video_device_config['exposure'])
+
+        if int(video_device_config['white_balance']) == -1:
+            modes['white_balance_automatic'] = 1
+        else:
+            modes['white_balance_automatic'] = 0
+            values['white_balance_temperature'] = int(video_device_config['white_balance'])
+        return [modes, values]
+
+    def apply(self, video_devices: list[str]):
+        """Sets the controls of the video devices, all at the same time
+
+        Args:
+            video_devices (list[str]): The internal names of the video devices (video0 and/or video1)
+        """
+        if os.name != 'posix':
+            print('Camera controls not supported on this OS')
+            return
+
+        if not video_devices:
+            return
+        with ThreadPoolExecutor(max_workers=len(video_devices)) as executor:
+            list(executor.map(self.apply_controls, video_devices))
+
+    def apply_controls(self, video_device: str):
+        """Sets the controls of one video device that don't already have the configured value"""
+        video_device_name = self.config.get_video_device_name(video_device)
+        values = self.get_values(video_device_name)
+        if values is None:
+            return
+
+        for controls in self.get_controls(video_device):
+            changed = {}
+            for control, value in controls.items():
+                # Skip controls the camera doesn't have, such as focus on a fixed-focus camera
+                name = next((name for name in CONTROL_NAMES[control] if name in values), None)
+                if name is None or values[name] == value:
+                    continue
+                changed[name] = value
+            if not changed:
+                continue
+
+            if self.set_controls(video_device_name, changed):
+                continue
+            # v4l2-ctl stops at the first control it can't set, so set the rest one at a time
+            for name, value in changed.items():
+                self.set_controls(video_device_name, {name: value})
+
+    def get_values(self, video_device_name: str) -> dict:
+        """Returns the supported controls of a video device and their current values
+
+        Returns:
+            dict: The value of each control by its name, or None if the controls couldn't be read
+        """
+        try:
+            result = subprocess.run(['v4l2-ctl', '-d', video_device_name, '--list-ctrls'], capture_output=True)
+        except FileNotFoundError:
+            print('v4l2-ctl is not installed, camera controls are not set')
+            return None
+        if result.returncode != 0:
+            print(f"Failed to read the controls of {video_device_name}: {result.stderr.decode('utf-8', errors='replace').strip()}")
+            return None
+        return parse_controls(result.stdout.decode('utf-8', errors='replace'))
+
+    def set_controls(self, video_device_name: str, controls: dict) -> bool:
+        """Sets controls of a video device in a single v4l2-ctl call, returning whether all of them were set"""
+        result = subprocess.run(['v4l2-ctl', '-d', video_device_name, '--set-ctrl', ','.join(f'{name}={value}' for name, value in controls.items())],
+                                capture_output=True)
+        if result.returncode != 0:
+            print(f"Failed to set {', '.join(controls)} on {video_device_name}: {result.stderr.decode('utf-8', errors='replace').strip()}")
+            return False
+        return True
+
+def parse_controls(output: str) -> dict:
+    """Returns the value of each control by its name from the output of v4l2-ctl --list-ctrls"""
+    return {name: int(value) for name, value in CONTROL_PATTERN.findall(output)}
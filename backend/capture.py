@@ -0,0 +1,146 @@
+import cv2
+import os
+import threading
+import time
+
+class CaptureSession():
+    def __init__(self, config, video_device: str):
+        """Keeps a video device open with a background thread grabbing frames from it, so that the
+        latest frame can be taken at any time without opening the camera and waiting for it to warm up.
+        The camera is released again after it hasn't been used for a while.
+
+        Args:
+            config (configuration.Configuration): The configuration
+            video_device (str): The name of the video device, either 'video0' or 'video1'
+        """
+        self.config = config
+        self.video_device = video_device
+        self.settings = self.get_settings()
+        self.capture_lock = threading.Lock() # the capture is used by the grabber thread and the callers of get_frame
+        self.grabbed = threading.Condition()
+        self.frames_grabbed = 0
+        self.last_used = time.time()
+        self.stopped = threading.Event()
+
+        if os.name == 'nt': # windows
+            self.capture = cv2.VideoCapture(self.config.get_video_device_index(video_device), cv2.CAP_DSHOW) # windows is slow if you don't use dshow
+        else: # linux
+            self.capture = cv2.VideoCapture(self.config.get_video_device_index(video_device))
+            self.capture.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter.fourcc('m','j','p','g'))
+            self.capture.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter.fourcc('M','J','P','G'))
+        self.capture.set(cv2.CAP_PROP_FRAME_WIDTH, self.config.config[video_device]['resolution'][0]) # set the X resolution
+        self.capture.set(cv2.CAP_PROP_FRAME_HEIGHT, self.config.config[video_device]['resolution'][1]) # set the Y resolution
+
+        self.thread = threading.Thread(target=self.grab_frames, daemon=True)
+        self.thread.start()
+
+    def get_settings(self) -> tuple:
+        """Returns the settings the video device is opened with, to tell when it needs to be reopened"""
+        return (self.config.get_video_device_index(self.video_device), tuple(self.config.config[self.video_device]['resolution']))
+
+    def grab_frames(self):
+        """Keeps grabbing frames so the latest one is always ready. Grabbed frames aren't decoded
+        until they are needed, which keeps this cheap."""
+        idle_timeout = self.config.config['capture']['idle_timeout']
+        failures = 0
+        while not self.stopped.is_set() and time.time() - self.last_used < idle_timeout:
+            with self.capture_lock:
+                ret = self.capture.grab()
+            if ret:
+                failures = 0
+                with self.grabbed:
+                    self.frames_grabbed += 1
+                    self.grabbed.notify_all()
+            else:
+                failures += 1
+                if failures >= 10: # the camera is gone or in use by something else
+                    break
+                time.sleep(0.1)
+
+        self.stopped.set()
+        with self.capture_lock:
+            self.capture.release()
+        with self.grabbed:
+            self.grabbed.notify_all()
+
+    def get_frame(self, timeout: float = 5):
+        """
+        Returns the latest frame from the video device, waiting for the camera to warm up if it was just opened.
+
+        Args:
+            timeout (float, optional): The most seconds to wait for a frame. Defaults to 5.
+
+        Returns:
+            numpy.ndarray: The frame, or None if the video device didn't deliver one.
+        """
+        self.last_used = time.time()
+        # Let the camera settle its exposure and focus, like the frames that used to be read and thrown away
+        warmup_frames = self.config.config['capture']['warmup_frames']
+        with self.grabbed:
+            self.grabbed.wait_for(lambda: self.frames_grabbed >= warmup_frames or self.stopped.is_set(), timeout)
+            if self.frames_grabbed == 0:
+                return None
+
+        with self.capture_lock:
+            if self.stopped.is_set():
+                return None
+            ret, frame = self.capture.retrieve()
+        return frame if ret else None
+
+    def is_open(self) -> bool:
+        """Returns whether the video device is still open with the current settings"""
+        return not self.stopped.is_set() and self.settings == self.get_settings()
+
+    def release(self):
+        """Stops grabbing frames and releases the video device"""
+        self.stopped.set()
+        self.thread.join()
+
+class CaptureManager():
+    def __init__(self, config):
+        """Shares one CaptureSession per video device between everything that needs a frame from the cameras,
+        such as the previews and autodetecting the corners. The sessions are closed while recording, so that
+        ffmpeg can take over the cameras.
+
+        Args:
+            config (configuration.Configuration): The configuration
+        """
+        self.config = config
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.suspended = False
+
+    def get_frame(self, video_device: str):
+        """
+        Returns the latest frame from the video device, opening it if needed.
+
+        Args:
+            video_device (str): The name of the video device, either 'video0' or 'video1'
+
+        Returns:
+            numpy.ndarray: The frame, or None if the video device couldn't be read or a recording is in progress.
+        """
+        with self.lock:
+            if self.suspended:
+                return None
+            session = self.sessions.get(video_device)
+            if session is None or not session.is_open():
+                # Reopen the video device if it was released while idle or its settings changed
+                if session is not None:
+                    session.release()
+                session = CaptureSession(self.config, video_device)
+                self.sessions[video_device] = session
+        return session.get_frame()
+
+    def suspend(self):
+        """Releases all the video devices and keeps them closed until resume() is called"""
+        with self.lock:
+            self.suspended = True
+            for session in self.sessions.values():
+                session.release()
+            self.sessions = {}
+
+    def resume(self):
+        """Allows the video devices to be opened again"""
+        with self.lock:
+            self.suspended = False
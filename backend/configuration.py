@@ -9,6 +9,19 @@ def get_av_splits():
 
     return output.split('(video)')
 
+def merge_defaults(config: dict, defaults: dict):
+    """Recursively adds any keys missing from config using the values in defaults
+
+    Args:
+        config (dict): The loaded configuration, modified in place
+        defaults (dict): The default configuration
+    """
+    for key, value in defaults.items():
+        if key not in config:
+            config[key] = value
+        elif isinstance(value, dict) and isinstance(config[key], dict):
+            merge_defaults(config[key], value)
+
 class Configuration:
     def __init__(self):
         if os.name == 'nt':
@@ -64,12 +77,20 @@ class Configuration:
     def load_config(self) -> dict:
         try:
             with open('config.toml', 'r') as file:
-                return toml.load(file)
+                config = toml.load(file)
         except FileNotFoundError:
             self.create_default_config()
             return self.load_config()
 
+        # Fill in any settings added since the config file was created
+        merge_defaults(config, self.get_default_config())
+        return config
+
     def create_default_config(self):
+        self.config = self.get_default_config()
+        self.save_config()
+
+    def get_default_config(self) -> dict:
         default_video_device = [str(self.video_devices[0][0]),str(self.video_devices[0][1])]
         default_audio_device = [str(self.audio_devices[0][0]),str(self.audio_devices[0][1])]
 
@@ -87,6 +108,7 @@ class Configuration:
                 'video_device': default_video_device,
                 'resolution': (1920, 1080),
                 'corners': [(0, 0), (0, 0), (0, 0), (0, 0)],
+                'marker_ids': [], # ids of the ArUco markers on the corners, set along with them, empty if unknown
                 'custom_video_device': "",
                 'custom_video_device_index': -1,
                 'streamcopy': False,
@@ -96,6 +118,8 @@ class Configuration:
                 'temp_processed_video_file': 'temp_processed_video0.mp4',
                 'pixel_format': '',
                 'focus': -1,
+                'exposure': -1, # exposure time in units of 100 microseconds, -1 for automatic
+                'white_balance': -1, # white balance temperature in kelvin, -1 for automatic
                 'autodetect_corners': False,
             },
             'video1': {
@@ -103,6 +127,7 @@ class Configuration:
                 'video_device': default_video_device,
                 'resolution': (1920, 1080),
                 'corners': [(0, 0), (0, 0), (0, 0), (0, 0)],
+                'marker_ids': [], # ids of the ArUco markers on the corners, set along with them, empty if unknown
                 'custom_video_device': "",
                 'custom_video_device_index': -1,
                 'streamcopy': False,
@@ -112,6 +137,8 @@ class Configuration:
                 'temp_processed_video_file': 'temp_processed_video1.mp4',
                 'pixel_format': '',
                 'focus': -1,
+                'exposure': -1, # exposure time in units of 100 microseconds, -1 for automatic
+                'white_balance': -1, # white balance temperature in kelvin, -1 for automatic
                 'autodetect_corners': False,
             },
             'files': {
@@ -125,10 +152,69 @@ class Configuration:
                 'enabled': False,
                 'names': '',
                 'times': ''
-            }
+            },
+            'recording': {
+                'live_processing': False, # warp and encode while recording instead of afterwards
+                'live_max_drop_ratio': 0.02, # fall back to processing afterwards if more than this fraction of frames can't be warped in time
+                'live_max_buffered_frames': 30, # frames waiting to be warped before new ones are dropped
+                'live_encoding_profile': 'fast', # encoding profile for live processing, which has to keep up with the cameras
+                'segment_length': 0, # seconds per segment file the recording is split into so a crash only loses the last one, 0 to record one file
+                'process_segments': False, # process each segment of a segmented recording as soon as it is finished, while still recording
+                'single_process': False, # record every camera and the audio in one ffmpeg process instead of one per camera, not used with live processing
+                'stop_timeout': 10, # most seconds to wait for ffmpeg to stop gracefully before terminating it
+            },
+            'jobs': {
+                'max_concurrent_jobs': 1, # jobs processed at the same time, the rest wait in a queue
+                'pause_while_recording': True, # pause processing while recording so the cameras don't drop frames
+                'nice': 10, # CPU priority of processing (Linux), from 0 (normal) to 19 (lowest)
+                'cpu_affinity': [], # CPUs that processing may use (Linux), empty for all of them
+            },
+            'capture': {
+                'idle_timeout': 60, # seconds the cameras are kept open for previews after the last frame was taken
+                'warmup_frames': 10, # frames a camera is given to settle its exposure after opening
+            },
+            'aruco': {
+                'detection_scale': 0.5, # scale frames are shrunk to before looking for markers, the corners are then refined at full resolution
+                'refine_window': 5, # half size in pixels of the window the marker corners are refined in, 0 to not refine them
+                'parameters': {}, # cv2.aruco.DetectorParameters to change, such as adaptiveThreshWinSizeMax = 23
+            },
+            'preview': {
+                'fps': 10, # framerate of the live preview streams
+                'width': 960, # width the live preview streams are scaled down to, 0 for the camera's resolution
+                'quality': 80, # JPEG quality of the live preview streams, from 0 to 100
+            },
+            'encoding': {
+                'profile': 'whiteboard', # 'whiteboard', 'fast', 'small' or 'av1'
+                # Override the settings of the profile, leave blank or -1 to use the profile's value
+                'codec': '', # libx264, libx265 or libsvtav1
+                'preset': '',
+                'crf': -1,
+                'tune': '',
+                'gop': -1, # frames between keyframes
+                'threads': 0, # encoder threads, 0 to let ffmpeg decide
+            },
+            'processing': {
+                'pipeline': 'files', # 'pipe' (warp, stack and encode in one ffmpeg pass), 'segmented' (pipe in parallel time segments) or 'files' (intermediate file per camera)
+                'output_resolution': (1920, 1080), # resolution of each camera in the output video
+                'warp_method': 'remap', # 'remap' (precomputed lookup tables) or 'perspective' (cv2.warpPerspective)
+                'workers': 1, # processes to warp frames with, 0 for one per CPU core, 1 to warp in the backend process
+                'max_frames_in_flight': 8, # frames buffered in shared memory for the worker processes
+                'segments': 0, # time segments for the segmented pipeline, 0 for one per warp process
+                'dedup_threshold': 0, # reuse the previous warped frame when a frame changed less than this (0-255), 0 to warp every frame
+                'slides': False, # save a still image to the job's slides directory whenever the board content changes
+                'slides_threshold': 8.0, # how much the board has to change (0-255) for a new slide
+                'concurrent_video_devices': 2, # cameras processed at the same time, 1 to process them one after another
+                'profiling': False, # time each step per frame and save a summary into the profile directory of the job
+                'cprofile': False, # also save a cProfile of each processing stage, needs profiling
+                'track_corners': False, # follow the ArUco markers during processing, in case a camera gets bumped
+                'track_corners_interval': 5.0, # seconds between looking for the markers
+                'track_corners_threshold': 4.0, # pixels a corner has to move before the warp is rebuilt
+                'track_corners_smoothing': 0.5, # share of the previous corner position kept each time a marker is found, 0-1
+                'track_corners_search_size': 0.25, # size of the square searched around each corner, as a fraction of the frame width
+                'track_corners_scale': 0.5, # scale the search regions are shrunk to before detecting markers
+            },
         }
-        self.config = default_config
-        self.save_config()
+        return default_config
 
     def save_config(self):
         with open('config.toml', 'w') as file:
@@ -159,6 +245,8 @@ class Configuration:
                 'temp_processed_video_file': self.config['video0']['temp_processed_video_file'],
                 'pixel_format': self.config['video0']['pixel_format'],
                 'focus': self.config['video0']['focus'],
+                'exposure': self.config['video0']['exposure'],
+                'white_balance': self.config['video0']['white_balance'],
                 'autodetect_corners': self.config['video0']['autodetect_corners'],
             },
             'video1': {
@@ -174,6 +262,8 @@ class Configuration:
                 'temp_processed_video_file': self.config['video1']['temp_processed_video_file'],
                 'pixel_format': self.config['video1']['pixel_format'],
                 'focus': self.config['video1']['focus'],
+                'exposure': self.config['video1']['exposure'],
+                'white_balance': self.config['video1']['white_balance'],
                 'autodetect_corners': self.config['video1']['autodetect_corners'],
             },
             'files': {
@@ -309,6 +399,13 @@ class Configuration:
             except ValueError as e:
                 raise TypeError(f"Expected {video}['focus'] to convert to an int ({e})")
 
+            # Convert exposure and white_balance to int
+            for control in ['exposure', 'white_balance']:
+                try:
+                    self.config[video][control] = int(data[video][control])
+                except ValueError as e:
+                    raise TypeError(f"Expected {video}['{control}'] to convert to an int ({e})")
+
             # Validate autodetect_corners
             if not isinstance(data[video]['autodetect_corners'], bool):
                 raise TypeError(f"Expected {video}['autodetect_corners'] to be a bool")
@@ -0,0 +1,12 @@
+import pytest
+import configuration
+import processing
+
+@pytest.fixture
+def config(tmp_path, monkeypatch):
+    """A default configuration kept in a temporary directory, so the tests never touch the real config.toml"""
+    monkeypatch.chdir(tmp_path)
+    config = configuration.Configuration()
+    config.config['files']['recording_directory'] = str(tmp_path.joinpath('recordings'))
+    yield config
+    processing.clear_warper_cache()
@@ -0,0 +1,51 @@
+import json
+import queue
+import threading
+
+class EventBroadcaster():
+    def __init__(self, max_queued_events: int = 100):
+        """Fans out events to every subscriber, such as the Server-Sent Events connection of each open page
+
+        Args:
+            max_queued_events (int, optional): The most events held for a subscriber that isn't keeping up,
+                after which new events are dropped for it. Defaults to 100.
+        """
+        self.max_queued_events = max_queued_events
+        self.subscribers = []
+        self.lock = threading.Lock()
+
+    def subscribe(self) -> queue.Queue:
+        """Returns a new queue that receives every event published from now on"""
+        subscriber = queue.Queue(self.max_queued_events)
+        with self.lock:
+            self.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: queue.Queue):
+        """Stops sending events to the subscriber"""
+        with self.lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+
+    def has_subscribers(self) -> bool:
+        """Returns whether anyone is listening for events"""
+        return len(self.subscribers) > 0
+
+    def publish(self, event: str, data):
+        """Sends an event to every subscriber
+
+        Args:
+            event (str): The name of the event
+            data: The JSON-serializable data of the event
+        """
+        message = format_event(event, data)
+        with self.lock:
+            for subscriber in self.subscribers:
+                try:
+                    subscriber.put_nowait(message)
+                except queue.Full:
+                    pass # the subscriber has stopped reading
+
+def format_event(event: str, data) -> str:
+    """Formats an event as a Server-Sent Events message"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
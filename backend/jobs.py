@@ -5,9 +5,17 @@ import os
 import time
 import pathlib
 import threading
+import multiprocessing
 import shutil
 import datetime
+import queue
+import itertools
+import json
 import aruco
+import events
+
+# Append-only journal kept in each job directory, so jobs survive restarts of the backend
+JOURNAL_FILE = 'job.jsonl'
 
 class JobManager():
     def __init__(self, config: configuration.Configuration, preview: processing.Preview):
@@ -16,8 +24,58 @@ class JobManager():
         self.preview = preview
         # self.processing_jobs = [ProcessingJob(config, 'test', pathlib.Path('recordings/test'))] # Test job
         self.processing_jobs = []
+        self.scheduler = JobScheduler(config)
+        self.load_jobs()
+
+        # Push job and recording updates to the frontend instead of having it poll
+        self.events = events.EventBroadcaster()
+        self.recording = False
+        self.published_jobs = None
+        self.event_thread = threading.Thread(target=self.publish_job_updates, daemon=True)
+        self.event_thread.start()
         self.current_recording_job_name = ''
         self.current_recording_job_directory = None # TODO: what's a default pathlib path
+        self.incremental_processor = None
+
+    def load_jobs(self):
+        """Rediscovers the jobs in the recording directory after a restart, resuming any that were
+        queued or in progress from their last completed stage. Jobs that failed are left for the user to run again."""
+        recording_directory = pathlib.Path(self.config.config['files']['recording_directory'])
+        if not recording_directory.exists():
+            return
+
+        for job_directory in sorted(recording_directory.iterdir()):
+            if not job_directory.is_dir():
+                continue
+            job = ProcessingJob.load(self.config, job_directory)
+            if job is None:
+                continue
+            self.processing_jobs.append(job)
+            if job.queued and not job.finished and not job.failed:
+                print(f"Resuming job {job.job_name}")
+                self.scheduler.submit(job)
+
+    def publish_job_updates(self):
+        """Publishes the jobs whenever they change, checking every second"""
+        while True:
+            time.sleep(1)
+            try:
+                if self.events.has_subscribers():
+                    self.publish_jobs()
+            except Exception as e:
+                # Keep publishing, a job changing while it's read shouldn't stop the updates for good
+                print(f"Failed to publish job updates: {e}")
+
+    def publish_jobs(self):
+        """Publishes the jobs to the frontend if they changed since they were last published"""
+        jobs = self.get_all_jobs()
+        if jobs != self.published_jobs:
+            self.published_jobs = jobs
+            self.events.publish('jobs', jobs)
+
+    def publish_recording_status(self):
+        """Publishes whether a recording is in progress to the frontend"""
+        self.events.publish('recording_status', {'recording_status': self.recording})
 
     def get_period_name(self):
         period_names = str(self.config.config['periods']['names']).split(',') # ordered list of period names
@@ -40,48 +98,82 @@ class JobManager():
 
     def start_recording(self):
         """Starts a new recording job"""
-        # Autodetect corners if needed
-        for video_device in ['video0', 'video1']:
-            if self.config.config[video_device]['enabled'] and self.config.config[video_device]['autodetect_corners']:
-                frame = self.preview.capture_frame(video_device)
-                if frame is None:
-                    print(f"Failed to capture frame to set corners for {video_device}")
-                    continue
-                try:
-                    aruco.set_video_corners(video_device, frame, self.config)
-                except ValueError as e:
-                    print(f"Failed to set corners for {video_device} because of {e}")
-                    continue
-
-        # Create a somewhat friendly job name based on the current time
-        self.current_recording_job_name = time.strftime(self.config.config['job_name_format'], time.localtime())
-
-        # Append the period name to the job name if periods are enabled
-        if self.config.config['periods']['enabled']:
-            period_name = self.get_period_name()
-            if period_name:
-                self.current_recording_job_name = f"{self.current_recording_job_name}_{period_name}"
-
-        # Create a new directory for the job in the config's recording_directory, which might not already exist
-        pathlib.Path(self.config.config['files']['recording_directory']).joinpath(pathlib.Path(self.current_recording_job_name)).mkdir(parents=True, exist_ok=True)
-        self.current_recording_job_directory = pathlib.Path(self.config.config['files']['recording_directory']).joinpath(pathlib.Path(self.current_recording_job_name))
-
-        self.video_recorder.start_recording(self.current_recording_job_directory)
+        # Keep background processing from competing with the cameras
+        if self.config.config['jobs']['pause_while_recording']:
+            self.scheduler.pause()
+
+        try:
+            # Autodetect corners if needed
+            for video_device in ['video0', 'video1']:
+                if self.config.config[video_device]['enabled'] and self.config.config[video_device]['autodetect_corners']:
+                    frame = self.preview.capture_frame(video_device)
+                    if frame is None:
+                        print(f"Failed to capture frame to set corners for {video_device}")
+                        continue
+                    try:
+                        aruco.set_video_corners(video_device, frame, self.config)
+                    except ValueError as e:
+                        print(f"Failed to set corners for {video_device} because of {e}")
+                        continue
+
+            # Create a somewhat friendly job name based on the current time
+            self.current_recording_job_name = time.strftime(self.config.config['job_name_format'], time.localtime())
+
+            # Append the period name to the job name if periods are enabled
+            if self.config.config['periods']['enabled']:
+                period_name = self.get_period_name()
+                if period_name:
+                    self.current_recording_job_name = f"{self.current_recording_job_name}_{period_name}"
+
+            # Create a new directory for the job in the config's recording_directory, which might not already exist
+            pathlib.Path(self.config.config['files']['recording_directory']).joinpath(pathlib.Path(self.current_recording_job_name)).mkdir(parents=True, exist_ok=True)
+            self.current_recording_job_directory = pathlib.Path(self.config.config['files']['recording_directory']).joinpath(pathlib.Path(self.current_recording_job_name))
+
+            # Hand the cameras over from the previews to ffmpeg
+            self.preview.captures.suspend()
+            self.video_recorder.start_recording(self.current_recording_job_directory)
+            if self.uses_incremental_processing():
+                # Process each segment as soon as the cameras finish it
+                self.incremental_processor = IncrementalProcessor(self.config, self.current_recording_job_directory, self.current_recording_job_name, self.scheduler.lower_priority)
+                self.incremental_processor.start()
+        except Exception:
+            # Don't leave processing paused and the previews without cameras when the recording can't start
+            self.video_recorder.stop_recording()
+            self.video_recorder.finish_live_processing()
+            self.preview.captures.resume()
+            self.scheduler.resume()
+            raise
+        self.recording = True
+        self.publish_recording_status()
 
     def stop_recording(self):
         """Stops the current recording job and adds it to the list of jobs to process"""
         self.video_recorder.stop_recording()
-        self.processing_jobs.append(ProcessingJob(self.config, self.current_recording_job_name, self.current_recording_job_directory))
+        self.preview.captures.resume()
+        self.recording = False
+        self.publish_recording_status()
+        live_processed = self.video_recorder.finish_live_processing()
+        if self.incremental_processor is not None:
+            self.incremental_processor.finish()
+            self.incremental_processor = None
+        self.scheduler.resume()
+        self.processing_jobs.append(ProcessingJob(self.config, self.current_recording_job_name, self.current_recording_job_directory, live_processed))
 
         # Automatically process the recording if auto_process_recordings is true
         if self.config.config['auto_process_recordings']:
             self.run_job(self.current_recording_job_name)
+        self.publish_jobs()
+
+    def uses_incremental_processing(self) -> bool:
+        """Returns whether recordings are processed segment by segment while they are recorded"""
+        recording_config = self.config.config['recording']
+        return recording_config['process_segments'] and recording_config['segment_length'] > 0 and not recording_config['live_processing']
 
     def run_jobs(self):
         """Runs all the jobs in the processing_jobs list"""
         for job in self.processing_jobs:
             if not job.started:
-                job.start()
+                self.scheduler.submit(job)
 
     def run_job(self, job_name):
         """Runs the job with the given name
@@ -92,7 +184,7 @@ class JobManager():
         for job in self.processing_jobs:
             if job.job_name == job_name:
                 if not job.started:
-                    job.start()
+                    self.scheduler.submit(job)
                 return
         raise Exception('Job not found')
     
@@ -100,7 +192,7 @@ class JobManager():
         """Returns the status of the job with the given name"""
         for job in self.processing_jobs:
             if job.job_name == job_name:
-                return job.progress_message
+                return job.get_progress_message()
         return 'Job not found'
     
     def get_all_jobs(self):
@@ -109,9 +201,10 @@ class JobManager():
         for job in self.processing_jobs:
             jobs.append({
                 "name": job.job_name,
-                "message": job.progress_message,
+                "message": job.get_progress_message(),
                 "started": job.started,
-                "finished": job.finished
+                "finished": job.finished,
+                "progress": job.get_progress()
             })
         return jobs
     
@@ -120,6 +213,7 @@ class JobManager():
         for job in self.processing_jobs:
             if job.job_name == job_name:
                 if not job.started or job.finished:
+                    job.record('removed')
                     self.processing_jobs.remove(job)
                 return
         raise Exception('Job not found')
@@ -142,8 +236,9 @@ class JobManager():
     
     def clear_finished_jobs(self):
         """Removes all the finished jobs from the processing_jobs list"""
-        for job in self.processing_jobs:
+        for job in list(self.processing_jobs):
             if job.finished:
+                job.record('removed')
                 self.processing_jobs.remove(job)
 
     def purge_recording_directory(self):
@@ -154,34 +249,265 @@ class JobManager():
             print('Recording directory already non-existent')
             pass
 
+class JobScheduler():
+    def __init__(self, config: configuration.Configuration):
+        """Runs processing jobs from a priority queue on a fixed number of worker threads,
+        so that running many jobs at once doesn't overload the computer
+
+        Args:
+            config (configuration.Configuration): The configuration
+        """
+        self.config = config
+        self.job_queue = queue.PriorityQueue()
+        self.sequence = itertools.count() # keeps jobs with the same priority in the order they were submitted
+        self.running = multiprocessing.get_context('spawn').Event() # cleared to pause processing, shared with the processes of the segmented pipeline
+        self.running.set()
+
+        self.workers = [threading.Thread(target=self.work, daemon=True) for i in range(max(int(config.config['jobs']['max_concurrent_jobs']), 1))]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, job):
+        """Queues the job to be processed once a worker is free"""
+        job.started = True
+        job.progress_message = 'Queued'
+        if not job.queued or job.failed:
+            job.queued = True
+            job.failed = False
+            job.record('queued')
+        job.video_processing.running = self.running
+        self.job_queue.put((self.get_priority(job), next(self.sequence), job))
+
+    def get_priority(self, job) -> tuple:
+        """Returns the sort key of the job, so that today's recordings are processed first, newest first"""
+        created = datetime.datetime.fromtimestamp(job.created)
+        return (created.date() != datetime.date.today(), -job.created)
+
+    def pause(self):
+        """Pauses processing between frames until resume is called"""
+        self.running.clear()
+
+    def resume(self):
+        """Resumes paused processing"""
+        self.running.set()
+
+    def work(self):
+        """Processes jobs from the queue, one at a time"""
+        self.lower_priority()
+        while True:
+            priority, sequence, job = self.job_queue.get()
+            self.running.wait() # don't start new jobs while paused
+            try:
+                job.process()
+            except Exception as e:
+                print(f"Job {job.job_name} failed: {e}")
+                job.progress_message = f"Failed: {e}"
+                job.stage = None
+                job.started = False # allow the job to be run again
+                job.failed = True
+                job.record('failed', error=str(e)) # so it isn't retried on every restart
+
+    def lower_priority(self):
+        """Lowers the CPU priority and restricts the CPUs of the calling worker thread, which the
+        ffmpeg and warping processes it starts inherit. Only supported on Linux."""
+        thread_id = threading.get_native_id()
+        try:
+            os.setpriority(os.PRIO_PROCESS, thread_id, int(self.config.config['jobs']['nice']))
+        except (AttributeError, OSError) as e:
+            print(f"Couldn't set processing priority: {e}")
+        if self.config.config['jobs']['cpu_affinity']:
+            try:
+                os.sched_setaffinity(thread_id, [int(cpu) for cpu in self.config.config['jobs']['cpu_affinity']])
+            except (AttributeError, OSError) as e:
+                print(f"Couldn't set processing CPU affinity: {e}")
+
+class IncrementalProcessor():
+    def __init__(self, config: configuration.Configuration, recording_directory: pathlib.Path, job_name: str, lower_priority):
+        """Processes a segmented recording while it is still being recorded, one part each time the cameras
+        finish a segment, so only the last segment is left to process once the recording stops. It runs at the
+        priority of background processing and warps in a single process, so it can't starve the cameras.
+
+        Args:
+            config (configuration.Configuration): The configuration
+            recording_directory (pathlib.Path): The directory of the recording job
+            job_name (str): The name of the recording job
+            lower_priority (function): Lowers the CPU priority of the calling thread, see JobScheduler.lower_priority
+        """
+        self.config = config
+        self.video_processing = processing.Processing(config, recording_directory, job_name)
+        self.job_name = job_name
+        self.lower_priority = lower_priority
+        self.stopped = threading.Event()
+        self.video_processing.cancelled = self.stopped # the part in progress is given up when the recording stops
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        """Starts watching the recording for finished segments"""
+        self.thread.start()
+
+    def run(self):
+        """Processes the finished segments until the recording stops"""
+        self.lower_priority()
+        segment_length = self.config.config['recording']['segment_length']
+        while not self.stopped.wait(min(segment_length / 2, 5)): # check for new segments a few times per segment
+            try:
+                # Catch up one segment at a time, so a part given up when the recording stops is short
+                while not self.stopped.is_set() and self.video_processing.process_finished_segments(segment_length):
+                    pass
+            except Exception as e:
+                if not self.stopped.is_set():
+                    print(f"Failed to process the finished segments of {self.job_name}: {e}")
+
+    def finish(self):
+        """Stops processing segments, giving up the part in progress, which is processed again with the rest of the recording"""
+        self.stopped.set()
+        self.thread.join()
+
 class ProcessingJob():
-    def __init__(self, config: configuration.Configuration, job_name: str, recording_directory: pathlib.Path):
+    def __init__(self, config: configuration.Configuration, job_name: str, recording_directory: pathlib.Path, live_processed: bool = False, created: float = None):
         self.config = config
         self.video_processing = processing.Processing(config, recording_directory, job_name)
         self.job_name = job_name
         self.recording_directory = recording_directory
+        self.live_processed = live_processed # whether the cameras were already warped while recording
+        self.created = created or time.time()
+        self.queued = False # whether the job has ever been submitted to run
+        self.completed_stages = []
+        self.stage = None # name of the stage being processed
+        self.stage_start_time = None
+        self.stage_times = {} # seconds taken by each stage
         self.started = False
         self.finished = False
+        self.failed = False # whether the last run failed, until it is queued again
         self.progress_message = 'Not started'
 
-    def start(self):
-        """Starts the processing job in a new thread"""
-        self.started = True
-        self.processing_thread = threading.Thread(target=self.process, daemon=True)
-        self.processing_thread.start()
-    
+        if not self.recording_directory.joinpath(JOURNAL_FILE).exists():
+            self.record('created', job_name=job_name, live_processed=live_processed, created=self.created)
+
+    @classmethod
+    def load(cls, config: configuration.Configuration, recording_directory: pathlib.Path):
+        """Restores a job from the journal in its directory
+
+        Args:
+            config (configuration.Configuration): The configuration
+            recording_directory (pathlib.Path): The directory of the job
+
+        Returns:
+            ProcessingJob: The restored job, or None if the directory doesn't hold a job that should be listed
+        """
+        journal_file = recording_directory.joinpath(JOURNAL_FILE)
+        if not journal_file.exists():
+            # Recordings from before the journal existed, or from a crash before the recording was stopped
+            recording_files = [recording_directory.joinpath(config.config[video_device]['temp_video_file']) for video_device in ['video0', 'video1']]
+            if not any(file.exists() or processing.get_segment_manifest(file).exists() for file in recording_files):
+                return None
+            return cls(config, recording_directory.name, recording_directory, created=recording_directory.stat().st_mtime)
+
+        with open(journal_file, 'r') as file:
+            journal = file.read()
+        if journal and not journal.endswith('\n'):
+            # Finish a line cut off by a crash so the next event starts on its own line
+            with open(journal_file, 'a') as file:
+                file.write('\n')
+
+        entries = []
+        for line in journal.splitlines():
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError: # a line cut off by a crash
+                continue
+        if not entries or entries[0]['event'] != 'created' or any(entry['event'] == 'removed' for entry in entries):
+            return None
+
+        job = cls(config, entries[0]['job_name'], recording_directory, entries[0]['live_processed'], entries[0]['created'])
+        for entry in entries[1:]:
+            if entry['event'] == 'queued':
+                job.queued = True
+                job.failed = False
+                job.progress_message = 'Not started'
+            elif entry['event'] == 'failed':
+                job.failed = True
+                job.progress_message = f"Failed: {entry.get('error', '')}"
+            elif entry['event'] == 'stage':
+                job.completed_stages.append(entry['stage'])
+                job.stage_times[entry['stage']] = entry.get('seconds', 0)
+            elif entry['event'] == 'finished':
+                job.started = True
+                job.finished = True
+                job.progress_message = 'Finished'
+        return job
+
+    def record(self, event: str, **details):
+        """Appends an event to the journal of the job"""
+        with open(self.recording_directory.joinpath(JOURNAL_FILE), 'a') as file:
+            file.write(json.dumps({'event': event, 'time': time.time(), **details}) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+
+    def get_progress_message(self):
+        """Returns the progress message, including how far through the current stage processing is"""
+        if self.progress_message == 'Processing recording':
+            return f"{self.progress_message} ({round(self.video_processing.get_progress() * 100)}%)"
+        if self.progress_message == 'Stacking output' and self.video_processing.ffmpeg_progress is not None:
+            return f"{self.progress_message} ({round(self.video_processing.ffmpeg_progress * 100)}%)"
+        return self.progress_message
+
+    def get_progress(self) -> dict:
+        """Returns the structured progress of the job: the current stage, the time taken by each stage,
+        and the frames processed, speed and estimated time remaining while processing"""
+        # Read once, since the processing thread changes these while this runs
+        stage, stage_start_time = self.stage, self.stage_start_time
+        stage_times = dict(self.stage_times)
+        if stage is not None:
+            stage_times[stage] = time.time() - stage_start_time
+        return {
+            'stage': stage,
+            'stage_times': {stage: round(seconds, 2) for stage, seconds in stage_times.items()},
+            **self.video_processing.get_progress_details(),
+        }
+
+    def get_stages(self) -> list[tuple]:
+        """Returns the (name, progress message, function) of each stage of processing the recording"""
+        if self.live_processed:
+            # Only the audio needs to be added back in
+            stages = [('stack_processed_videos', 'Stacking output', self.video_processing.stack_processed_videos)]
+        elif self.recording_directory.joinpath('incremental').exists() or 'process_recording_incremental' in self.completed_stages:
+            # Parts were processed while recording, only the rest of the recording is left
+            stages = [('process_recording_incremental', 'Processing recording', self.video_processing.process_recording_incremental)]
+        elif self.config.config['processing']['pipeline'] == 'pipe':
+            # Warping, stacking and encoding all happen in a single pass
+            stages = [('process_recording_piped', 'Processing recording', self.video_processing.process_recording_piped)]
+        elif self.config.config['processing']['pipeline'] == 'segmented':
+            # The single pass is split into time segments processed in parallel
+            stages = [('process_recording_segmented', 'Processing recording', self.video_processing.process_recording_segmented)]
+        else:
+            stages = [('process_recording', 'Processing recording', self.video_processing.process_recording),
+                      ('stack_processed_videos', 'Stacking output', self.video_processing.stack_processed_videos)]
+        stages.append(('copy_output', 'Copying output', self.copy_output))
+        return stages
+
     def process(self):
-        """Processes the recording"""
-        self.progress_message = 'Extracting audio'
-        self.video_processing.extract_audio()
-        self.progress_message = 'Processing recording'
-        self.video_processing.process_recording()
-        self.progress_message = 'Stacking output'
-        self.video_processing.stack_processed_videos()
-        self.progress_message = 'Copying output'
+        """Processes the recording, skipping any stages completed before a restart"""
+        for stage, message, function in self.get_stages():
+            if stage in self.completed_stages:
+                continue
+            self.progress_message = message
+            self.stage_start_time = time.time() # set first, the stage is read without a lock
+            self.stage = stage
+            self.video_processing.ffmpeg_progress = None
+            with self.video_processing.profiling(stage):
+                function()
+            self.stage_times[stage] = time.time() - self.stage_start_time
+            self.stage = None
+            self.completed_stages.append(stage)
+            self.record('stage', stage=stage, seconds=round(self.stage_times[stage], 2))
+        self.progress_message = 'Finished'
+        self.finished = True
+        self.record('finished')
+
+    def copy_output(self):
+        """Copies the output video to the recording copy directory, if there is one"""
         if self.config.config['files']['recording_copy_directory'] != '':
             if not pathlib.Path(self.config.config['files']['recording_copy_directory']).exists():
                 pathlib.Path(self.config.config['files']['recording_copy_directory']).mkdir(parents=True, exist_ok=True)
             os.system(f'cp {self.recording_directory.joinpath(f"{self.job_name}.mp4").as_posix()} {pathlib.Path(self.config.config["files"]["recording_copy_directory"]).as_posix()}')
-        self.progress_message = 'Finished'
-        self.finished = True
\ No newline at end of file
@@ -0,0 +1,131 @@
+import pathlib
+import threading
+import queue
+import subprocess
+import numpy as np
+import processing
+
+class LiveProcessor():
+    def __init__(self, config, recording_directory: pathlib.Path, video_device: str, frame_size: tuple, fps: float):
+        """Warps and encodes the frames of a camera while it is still recording, so the corrected video
+        is ready as soon as the recording stops. If warping can't keep up with the camera, live processing
+        gives up and the recording is processed afterwards from the raw video file as usual.
+
+        Args:
+            config (configuration.Configuration): The configuration
+            recording_directory (pathlib.Path): The directory of the recording job
+            video_device (str): The name of the video device being recorded
+            frame_size (tuple): The (width, height) of the raw frames ffmpeg outputs
+            fps (float): The framerate of the camera
+        """
+        self.config = config
+        self.video_device = video_device
+        self.frame_size = tuple(frame_size)
+        self.fps = fps
+        self.recording_directory = recording_directory
+        self.output_file = recording_directory.joinpath(config.config[video_device]['temp_processed_video_file']).as_posix()
+
+        self.frames = queue.Queue(int(config.config['recording']['live_max_buffered_frames']))
+        self.frames_captured = 0
+        self.frames_dropped = 0
+        self.failed = False
+        self.threads = []
+
+    def start(self, capture_process: subprocess.Popen):
+        """Starts reading raw frames from the stdout of the ffmpeg capture process and processing them"""
+        self.capture_process = capture_process
+        self.threads = [threading.Thread(target=self.read_frames, daemon=True),
+                        threading.Thread(target=self.process_frames, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def finish(self) -> bool:
+        """Waits for the remaining frames to be processed once the capture process has exited
+
+        Returns:
+            bool: Whether the processed video is complete and can be used instead of processing the raw video
+        """
+        for thread in self.threads:
+            thread.join()
+        print(f"Live processing of {self.video_device} dropped {self.frames_dropped} of {self.frames_captured} frames")
+        return not self.failed
+
+    def read_frames(self):
+        """Reads raw frames from the capture process, dropping them if processing falls behind"""
+        frame_bytes = self.frame_size[0] * self.frame_size[1] * 3
+        dropped_since_last_frame = 0
+        while True:
+            data = self.capture_process.stdout.read(frame_bytes)
+            if len(data) < frame_bytes:
+                break
+            self.frames_captured += 1
+
+            # Keep draining the pipe after giving up, otherwise ffmpeg would stall
+            if self.failed:
+                continue
+
+            frame = np.frombuffer(data, dtype=np.uint8).reshape(self.frame_size[1], self.frame_size[0], 3)
+            try:
+                self.frames.put_nowait((frame, dropped_since_last_frame))
+                dropped_since_last_frame = 0
+            except queue.Full:
+                self.frames_dropped += 1
+                dropped_since_last_frame += 1
+                self.check_drop_ratio()
+
+        # Mark the end of the recording, unless processing has already stopped
+        while not self.failed:
+            try:
+                self.frames.put((None, dropped_since_last_frame), timeout=0.1)
+                break
+            except queue.Full:
+                continue
+
+    def check_drop_ratio(self):
+        """Gives up on live processing if too many frames have been dropped"""
+        # Allow some time to warm up before judging
+        if self.frames_captured < self.fps * 10:
+            return
+        if self.frames_dropped / self.frames_captured > float(self.config.config['recording']['live_max_drop_ratio']):
+            print(f"Live processing of {self.video_device} can't keep up, falling back to processing after recording")
+            self.failed = True
+
+    def get_frames(self):
+        """Yields the frames to encode, with None in place of each dropped frame so the timing is kept"""
+        while True:
+            try:
+                frame, dropped_before = self.frames.get(timeout=0.1)
+            except queue.Empty:
+                if self.failed:
+                    return
+                continue
+            if self.failed:
+                return
+            for i in range(dropped_before):
+                yield None
+            if frame is None: # end of the recording
+                return
+            yield frame
+
+    def process_frames(self):
+        """Warps the frames from the queue and encodes them into the processed video file"""
+        video_processing = processing.Processing(self.config, self.recording_directory)
+        output_resolution = tuple(self.config.config['processing']['output_resolution'])
+        out_file = processing.FFmpegWriter(self.output_file, output_resolution, self.fps,
+                                           processing.get_video_codec_args(self.config, self.config.config['recording']['live_encoding_profile']))
+        try:
+            frames = self.get_frames()
+            if self.config.config['processing']['dedup_threshold'] > 0:
+                frames = processing.skip_unchanged_frames(frames, self.config.config['processing']['dedup_threshold'])
+            for warped in video_processing.warp_frames(frames, self.video_device):
+                if warped is not None:
+                    out_file.write(warped)
+        except Exception as e:
+            print(f"Live processing of {self.video_device} failed: {e}")
+            self.failed = True
+        finally:
+            try:
+                out_file.release()
+            except Exception as e:
+                print(e)
+                self.failed = True
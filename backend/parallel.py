@@ -0,0 +1,133 @@
+import multiprocessing
+from multiprocessing import shared_memory
+from collections import deque
+import cv2
+import numpy as np
+import processing
+
+# State of each worker process, set up once by _init_worker
+_worker = {}
+
+class ParallelWarper():
+    def __init__(self, transform_matrix: np.ndarray, output_size: tuple, method: str = 'remap', workers: int = 2, max_frames_in_flight: int = 8):
+        """Warps a stream of frames across a pool of worker processes, yielding them back in their original order.
+        Frames are passed to and from the workers through shared memory instead of being pickled.
+
+        Args:
+            transform_matrix (np.ndarray): The perspective transform from the input frame to the output frame
+            output_size (tuple): The (width, height) of the output frame
+            method (str, optional): The warp method, see processing.Warper. Defaults to 'remap'.
+            workers (int, optional): The number of worker processes. Defaults to 2.
+            max_frames_in_flight (int, optional): The most frames held in shared memory at once, which caps memory use. Defaults to 8.
+        """
+        self.transform_matrix = transform_matrix
+        self.output_size = tuple(output_size)
+        self.method = method
+        self.workers = workers
+        self.slots = max(max_frames_in_flight, 1)
+
+        self.pool = None
+        self.input_memory = None
+        self.output_memory = None
+
+    def warp_stream(self, frames):
+        """Warps every frame from an iterable in parallel
+
+        Args:
+            frames (iterable): The frames to warp, all of the same shape. None repeats the previous warped frame.
+
+        Yields:
+            numpy.ndarray: The warped frames in their original order
+        """
+        pending = deque() # (slot, result) for each frame being warped, oldest first, where a slot of None repeats the previous frame
+        free_slots = []
+        last_output = None
+
+        try:
+            for frame in frames:
+                if frame is None:
+                    pending.append((None, None))
+                    continue
+
+                if self.pool is None:
+                    self.start(frame.shape)
+                    free_slots = list(range(self.slots))
+
+                # Wait for the oldest frames if every slot is in use
+                while not free_slots:
+                    slot = self.collect(pending)
+                    if slot is not None:
+                        free_slots.append(slot)
+                        last_output = self.outputs[slot].copy()
+                    yield last_output
+
+                slot = free_slots.pop()
+                self.inputs[slot][...] = frame
+                # The matrix goes with every frame, so frames already in flight keep the warp they were sent with
+                pending.append((slot, self.pool.apply_async(_warp_slot, (slot, self.transform_matrix))))
+
+            while pending:
+                slot = self.collect(pending)
+                if slot is not None:
+                    last_output = self.outputs[slot].copy()
+                yield last_output
+        finally:
+            self.close()
+
+    def set_transform_matrix(self, transform_matrix: np.ndarray):
+        """Changes the perspective transform of the frames warped from now on"""
+        self.transform_matrix = transform_matrix
+
+    def start(self, input_shape: tuple):
+        """Creates the shared memory for the given frame shape and starts the worker processes"""
+        output_shape = (self.output_size[1], self.output_size[0]) + tuple(input_shape[2:])
+        self.input_memory = shared_memory.SharedMemory(create=True, size=self.slots * int(np.prod(input_shape)))
+        self.output_memory = shared_memory.SharedMemory(create=True, size=self.slots * int(np.prod(output_shape)))
+        self.inputs = np.ndarray((self.slots,) + tuple(input_shape), dtype=np.uint8, buffer=self.input_memory.buf)
+        self.outputs = np.ndarray((self.slots,) + output_shape, dtype=np.uint8, buffer=self.output_memory.buf)
+
+        # Spawn the workers instead of forking them, so they don't inherit the open files of this process, such as the stdin
+        # of the ffmpeg process being encoded to, which ffmpeg would otherwise wait on forever if processing fails
+        self.pool = multiprocessing.get_context('spawn').Pool(self.workers, initializer=_init_worker,
+                                         initargs=(self.input_memory.name, self.output_memory.name, self.inputs.shape, self.outputs.shape,
+                                                   self.transform_matrix, self.output_size, self.method))
+
+    def collect(self, pending: deque) -> int:
+        """Waits for the oldest pending frame to be warped and returns its slot, or None for a repeated frame"""
+        slot, result = pending.popleft()
+        if result is not None:
+            result.get()
+        return slot
+
+    def close(self):
+        """Stops the worker processes and frees the shared memory"""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        if self.input_memory is not None:
+            # The numpy views must be released before the shared memory can be closed
+            self.inputs = None
+            self.outputs = None
+            for memory in [self.input_memory, self.output_memory]:
+                memory.close()
+                memory.unlink()
+            self.input_memory = None
+            self.output_memory = None
+
+def _init_worker(input_name, output_name, input_shape, output_shape, transform_matrix, output_size, method):
+    """Attaches a worker process to the shared frame buffers and builds its warper"""
+    cv2.setNumThreads(1) # the pool provides the parallelism
+    _worker['input_memory'] = shared_memory.SharedMemory(name=input_name)
+    _worker['output_memory'] = shared_memory.SharedMemory(name=output_name)
+    _worker['inputs'] = np.ndarray(input_shape, dtype=np.uint8, buffer=_worker['input_memory'].buf)
+    _worker['outputs'] = np.ndarray(output_shape, dtype=np.uint8, buffer=_worker['output_memory'].buf)
+    _worker['warper'] = processing.Warper(transform_matrix, output_size, method)
+
+def _warp_slot(slot: int, transform_matrix: np.ndarray) -> int:
+    """Warps the frame in the given input slot into the matching output slot, rebuilding the
+    worker's warper first if the transform changed"""
+    if not np.array_equal(transform_matrix, _worker['warper'].transform_matrix):
+        _worker['warper'].set_transform_matrix(transform_matrix)
+    _worker['warper'].warp(_worker['inputs'][slot], _worker['outputs'][slot])
+    return slot
@@ -4,6 +4,40 @@ import numpy as np
 import time
 import subprocess
 import os
+import threading
+import multiprocessing
+import queue
+import shutil
+import csv
+import copy
+import contextlib
+import cProfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import parallel
+import capture
+import aruco
+import profiler
+
+# Audio codecs that can be copied into an mp4 file without transcoding
+MP4_AUDIO_CODECS = ['aac', 'mp3', 'ac3', 'eac3', 'alac']
+
+# Encoder settings for each encoding profile, individual settings can be overridden in the encoding config
+ENCODING_PROFILES = {
+    # Mostly static content, so long GOPs and a high CRF still look sharp
+    'whiteboard': {'codec': 'libx264', 'preset': 'medium', 'crf': 26, 'tune': 'stillimage', 'gop': 300},
+    # Keeps up with live processing on slower computers at the cost of larger files
+    'fast': {'codec': 'libx264', 'preset': 'veryfast', 'crf': 24, 'tune': 'stillimage', 'gop': 300},
+    # Smallest files, but much slower to encode
+    'small': {'codec': 'libx265', 'preset': 'medium', 'crf': 30, 'tune': '', 'gop': 600},
+    'av1': {'codec': 'libsvtav1', 'preset': '8', 'crf': 38, 'tune': '', 'gop': 600},
+}
+
+# Pause event of the job a segment worker process is processing for, set by _init_segment_worker
+_segment_running = None
+
+# Warpers built by Processing.get_warper, keyed by video device, corners, output size and warp method
+_warper_cache = {}
+_warper_cache_lock = threading.Lock()
 
 class Processing():
     def __init__(self, config, recording_directory: pathlib.Path, job_name: str = None):
@@ -11,60 +45,556 @@ class Processing():
         self.recording_directory = recording_directory
         self.job_name = job_name
 
-    def extract_audio(self):
-        """Extracts the audio from the video file, saving it as a temporary mp3 file"""
-        # Extract the audio from the video
-        # TODO: maybe not best to hardcode video0
-        temp_video_file_path = self.recording_directory.joinpath(self.config.config['video0']['temp_video_file']).as_posix()
-        temp_audio_file_path = self.recording_directory.joinpath(self.config.config['files']['temp_audio_file']).as_posix()
-        subprocess.run(['ffmpeg','-hide_banner','-y','-i',temp_video_file_path,'-codec:a','libmp3lame',temp_audio_file_path])
+        # Processing waits between frames while this is cleared, see jobs.JobScheduler
+        self.running = None
+        # Processing gives up between frames once this is set, see jobs.IncrementalProcessor
+        self.cancelled = None
+
+        # Frames processed so far and expected in total for each video device
+        self.frames_processed = {}
+        self.frames_total = {}
+        self.processing_start_times = {}
+        self.processing_finish_times = {}
+        # Fraction of the current ffmpeg-only step (stacking or joining) completed, None when there isn't one
+        self.ffmpeg_progress = None
+
+        # Per-frame timings of each step, only collected when profiling is enabled
+        self.profiler = profiler.Profiler() if self.config.config['processing']['profiling'] else None
 
     def process_recording(self):
         """Processes the video file that was just recorded"""
         start_time = time.time()
-        for video_device in self.config.get_enabled_video_devices():
+        video_devices = self.config.get_enabled_video_devices()
+
+        def process_video_device(video_device):
             print(f"Processing video from {video_device}")
-            
+
             # Get the file paths
-            temp_video_file = self.recording_directory.joinpath(self.config.config[video_device]['temp_video_file']).as_posix()
+            temp_video_file = self.get_recording_file(video_device)
             temp_processed_video_file = self.recording_directory.joinpath(self.config.config[video_device]['temp_processed_video_file']).as_posix()
 
             self.process_video(temp_video_file, temp_processed_video_file, video_device)
+
+        # Process the cameras side by side, OpenCV releases the GIL while decoding, warping and encoding
+        with ThreadPoolExecutor(max_workers=self.get_concurrent_video_device_count()) as executor:
+            list(executor.map(process_video_device, video_devices)) # list() raises any exceptions from the threads
         # Now we end up with two processed video files, one for each video device
 
         duration = time.time() - start_time
         print(f"Processed recording in {round(duration, 3)} seconds")
 
+    def process_recording_piped(self):
+        """Processes the recording in a single pass, piping the warped (and stacked) frames straight into
+        one ffmpeg process that encodes the output video and muxes the audio back in"""
+        start_time = time.time()
+        output_video_file = self.recording_directory.joinpath(f"{self.job_name}.mp4").as_posix()
+        frame_count = self.encode_stacked_video(output_video_file, self.get_audio_source(), workers=self.get_worker_count())
+
+        duration = time.time() - start_time
+        print(f"Processed {frame_count} frames in {round(duration, 3)} seconds: {round(frame_count/duration, 3)} fps")
+
+    def process_recording_segmented(self):
+        """Processes the recording by splitting it into time segments that are warped and encoded in separate
+        processes, then joined together without re-encoding. Finished segments are kept until the whole
+        recording is done, so a job that crashes only has to redo the unfinished segments when it is run again."""
+        start_time = time.time()
+        segment_directory = self.recording_directory.joinpath('segments')
+        segment_directory.mkdir(exist_ok=True)
+
+        # Split the output frames into one segment per worker
+        output_fps, frame_count = self.get_output_timing()
+        segment_count = max(min(self.get_segment_count(), frame_count), 1)
+        boundaries = [round(frame_count * i / segment_count) for i in range(segment_count + 1)]
+        segments = [(boundaries[i], boundaries[i + 1], segment_directory.joinpath(f"segment_{boundaries[i]}_{boundaries[i + 1]}.mp4")) for i in range(segment_count)]
+
+        self.frames_total = {'segments': frame_count}
+        self.frames_processed = {'segments': 0}
+        self.processing_start_times = {'segments': time.time()}
+        # The workers wait on the same event as this process whenever processing is paused, see jobs.JobScheduler
+        with ProcessPoolExecutor(max_workers=segment_count, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_segment_worker, initargs=(self.running,)) as executor:
+            futures = {}
+            for start_index, end_index, segment_file in segments:
+                # Skip segments finished by a previous attempt
+                if segment_file.with_suffix('.done').exists():
+                    self.frames_processed['segments'] += end_index - start_index
+                    continue
+                futures[executor.submit(_process_segment, self.config, self.recording_directory, self.job_name, start_index, end_index, segment_file)] = (start_index, end_index, segment_file)
+
+            for future in as_completed(futures):
+                start_index, end_index, segment_file = futures[future]
+                future.result() # raises any exception from the worker
+                segment_file.with_suffix('.done').touch()
+                self.frames_processed['segments'] += end_index - start_index
+        self.processing_finish_times['segments'] = time.time()
+
+        self.join_video_files([segment_file for start_index, end_index, segment_file in segments], frame_count / output_fps)
+        shutil.rmtree(segment_directory)
+
+        duration = time.time() - start_time
+        print(f"Processed {frame_count} frames in {segment_count} segments in {round(duration, 3)} seconds: {round(frame_count/duration, 3)} fps")
+
+    def process_finished_segments(self, max_seconds: float = None) -> bool:
+        """Processes the part of a segmented recording that the cameras have finished recording since the
+        last call, while the recording is still going. Each part is saved into the incremental directory of
+        the job and joined into the output video by process_recording_incremental.
+
+        Args:
+            max_seconds (float, optional): The most seconds of the recording to process in one part. Defaults to None for all of them.
+
+        Returns:
+            bool: Whether a part was processed
+        """
+        # Wait until every camera has finished its first segment
+        for video_device in self.get_stacked_video_devices():
+            manifest_file = get_segment_manifest(self.recording_directory.joinpath(self.config.config[video_device]['temp_video_file']))
+            if not manifest_file.exists() or not read_segment_manifest(manifest_file):
+                return False
+
+        # Only the frames that every camera has recorded so far can be stacked
+        output_fps, frame_count = self.get_output_timing(shortest=True)
+        parts = self.get_incremental_parts()
+        start_index = parts[-1][1] if parts else 0
+        end_index = min(frame_count, start_index + round(max_seconds * output_fps)) if max_seconds else frame_count
+        if end_index <= start_index:
+            return False
+
+        print(f"Processing frames {start_index} to {end_index} of {self.job_name} while recording")
+        with self.profiling(f"part_{start_index}_{end_index}"):
+            self.process_incremental_part(start_index, end_index)
+        return True
+
+    def process_recording_incremental(self):
+        """Finishes a recording that was partly processed while it was recorded: the frames after the last
+        part are processed, then all the parts are joined without re-encoding and the audio is added"""
+        start_time = time.time()
+        output_fps, frame_count = self.get_output_timing()
+        parts = self.get_incremental_parts()
+        start_index = parts[-1][1] if parts else 0
+        if start_index < frame_count:
+            self.process_incremental_part(start_index, frame_count, self.get_worker_count())
+            parts = self.get_incremental_parts()
+
+        self.join_video_files([part_file for part_start, part_end, part_file in parts], frame_count / output_fps)
+        shutil.rmtree(self.recording_directory.joinpath('incremental'))
+
+        duration = time.time() - start_time
+        print(f"Processed the last {frame_count - start_index} of {frame_count} frames in {round(duration, 3)} seconds")
+
+    def process_incremental_part(self, start_index: int, end_index: int, workers: int = 1):
+        """Warps and encodes the output frames in [start_index, end_index) into a silent part in the incremental directory"""
+        incremental_directory = self.recording_directory.joinpath('incremental')
+        incremental_directory.mkdir(exist_ok=True)
+        part_file = incremental_directory.joinpath(f"part_{start_index}_{end_index}.mp4")
+        self.encode_stacked_video(part_file.as_posix(), start_index=start_index, end_index=end_index, workers=workers)
+        part_file.with_suffix('.done').touch()
+
+    def get_incremental_parts(self) -> list[tuple]:
+        """Returns the (start index, end index, file) of the finished parts in the incremental directory that
+        follow on from each other from the start of the recording, in order"""
+        parts = []
+        incremental_directory = self.recording_directory.joinpath('incremental')
+        if incremental_directory.exists():
+            for done_file in incremental_directory.glob('part_*.done'):
+                start_index, end_index = done_file.stem.split('_')[1:]
+                parts.append((int(start_index), int(end_index), done_file.with_suffix('.mp4')))
+        parts.sort()
+
+        # Drop any parts that don't line up, such as from a recording processed with a different framerate
+        contiguous_parts = []
+        for part in parts:
+            if part[0] == (contiguous_parts[-1][1] if contiguous_parts else 0):
+                contiguous_parts.append(part)
+        return contiguous_parts
+
+    def join_video_files(self, video_files: list[pathlib.Path], duration: float):
+        """Joins silent video files with the concat demuxer without re-encoding them and adds the audio,
+        writing the output video of the job
+
+        Args:
+            video_files (list[pathlib.Path]): The video files to join, in order and all in the same directory
+            duration (float): The expected duration of the output in seconds
+        """
+        concat_list_file = video_files[0].parent.joinpath('files.txt')
+        with open(concat_list_file, 'w') as file:
+            for video_file in video_files:
+                file.write(f"file '{video_file.name}'\n")
+        output_video_file = self.recording_directory.joinpath(f"{self.job_name}.mp4").as_posix()
+        audio_source = self.get_audio_source()
+        returncode = self.run_ffmpeg(['ffmpeg','-hide_banner','-y',
+                                      '-f','concat','-safe','0','-i',concat_list_file.as_posix(),
+                                      '-i',audio_source,
+                                      '-map','0:v:0','-map','1:a:0?','-codec:v','copy',*get_audio_codec_args(audio_source),
+                                      output_video_file], duration)
+        if returncode != 0:
+            raise Exception(f"ffmpeg failed to join the video files of {self.job_name}")
+
+    def process_segment(self, start_index: int, end_index: int, segment_file: pathlib.Path):
+        """Warps and encodes the output frames in [start_index, end_index) into a silent segment file"""
+        print(f"Processing frames {start_index} to {end_index}")
+        with self.profiling(f"segment_{start_index}_{end_index}"):
+            self.encode_stacked_video(segment_file.as_posix(), start_index=start_index, end_index=end_index)
+
+    def encode_stacked_video(self, output_video_file: str, audio_source: str = None, start_index: int = 0, end_index: int = None, workers: int = 1) -> int:
+        """Warps and stacks the frames from every camera and pipes them into ffmpeg to encode
+
+        Args:
+            output_video_file (str): The path of the video file to write
+            audio_source (str, optional): A media file to take the audio track from. Defaults to None for no audio.
+            start_index (int, optional): The first output frame to encode. Defaults to 0.
+            end_index (int, optional): The output frame to stop before. Defaults to None for the end of the recording.
+            workers (int, optional): The number of processes to warp with, shared between the cameras. Defaults to 1.
+
+        Returns:
+            int: The number of frames encoded
+        """
+        video_devices = self.get_stacked_video_devices()
+        videos = [cv2.VideoCapture(self.get_recording_file(video_device)) for video_device in video_devices]
+        output_fps = max(video.get(cv2.CAP_PROP_FPS) for video in videos) # choose the highest framerate of the videos
+
+        # Each camera is read at the output framerate and warped straight into the output resolution
+        workers = workers // len(video_devices) # share the workers between the cameras
+        warped_streams = []
+        for video, video_device in zip(videos, video_devices):
+            frames_total = round(video.get(cv2.CAP_PROP_FRAME_COUNT) * output_fps / (video.get(cv2.CAP_PROP_FPS) or output_fps))
+            self.frames_total[video_device] = min(frames_total, end_index or frames_total) - start_index
+            warped_stream = self.get_warped_stream(video, video_device, output_fps, start_index, end_index, workers)
+            # Warp the cameras side by side instead of taking turns
+            if self.get_concurrent_video_device_count() > 1 and len(video_devices) > 1:
+                warped_stream = threaded_stream(warped_stream, self.config.config['processing']['max_frames_in_flight'])
+            warped_streams.append(warped_stream)
+
+        out_file = FFmpegWriter(output_video_file, self.get_stacked_frame_size(len(video_devices)), output_fps, get_video_codec_args(self.config), audio_source)
+
+        frame_count = 0
+        try:
+            for frames in stack_streams(warped_streams):
+                with self.measure('stack'):
+                    frame = self.stack_frames(frames)
+                with self.measure('write'):
+                    out_file.write(frame)
+                frame_count += 1
+        except BaseException:
+            # The video is unusable anyway, so don't wait for ffmpeg to encode the frames it has buffered
+            out_file.abort()
+            raise
+        finally:
+            # Stop the warping first, so no worker is still using the videos or holding the shared memory
+            for warped_stream in warped_streams:
+                warped_stream.close()
+            for video in videos:
+                video.release()
+        out_file.release()
+        return frame_count
+
+    def get_output_timing(self, shortest: bool = False) -> tuple:
+        """Returns the framerate and number of frames of the stacked output video
+
+        Args:
+            shortest (bool, optional): Count the frames of the shortest recording instead of the longest. Defaults to False.
+        """
+        output_fps = 0
+        durations = []
+        for video_device in self.get_stacked_video_devices():
+            video = cv2.VideoCapture(self.get_recording_file(video_device))
+            video_fps = video.get(cv2.CAP_PROP_FPS)
+            output_fps = max(output_fps, video_fps) # choose the highest framerate of the videos
+            durations.append(video.get(cv2.CAP_PROP_FRAME_COUNT) / video_fps if video_fps else 0)
+            video.release()
+        if shortest:
+            return output_fps, int(min(durations) * output_fps) # only whole frames that every camera has
+        return output_fps, round(max(durations) * output_fps)
+
+    def get_audio_source(self) -> str:
+        """Returns the path of the recording to take the audio from"""
+        # The audio is muxed straight from the original recording of the first enabled camera
+        return self.get_recording_file(self.config.get_enabled_video_devices()[0])
+
+    def get_recording_file(self, video_device: str) -> str:
+        """Returns the path of the recording of a video device. A segmented recording is opened through
+        a concat list of its finished segments, so it can be read like a single video file."""
+        recording_file = self.recording_directory.joinpath(self.config.config[video_device]['temp_video_file'])
+        if get_segment_manifest(recording_file).exists():
+            return write_segment_concat_list(recording_file).as_posix()
+        return recording_file.as_posix()
+
+    def get_segment_count(self) -> int:
+        """Returns the number of time segments to split the recording into"""
+        segments = int(self.config.config['processing']['segments'])
+        if segments <= 0: # automatic
+            segments = self.get_worker_count()
+        return segments
+
+    def get_warped_stream(self, video: cv2.VideoCapture, video_device: str, output_fps: float, start_index: int = 0, end_index: int = None, workers: int = 1):
+        """Builds the stream of warped frames for one camera: frames are read at the output framerate,
+        frames where the board hasn't changed skip the warp, and slides are saved if enabled
+
+        Args:
+            video (cv2.VideoCapture): The recording from the video device
+            video_device (str): The name of the video device
+            output_fps (float): The framerate of the output video
+            start_index (int, optional): The first output frame. Defaults to 0.
+            end_index (int, optional): The output frame to stop before. Defaults to None for the end of the video.
+            workers (int, optional): The number of processes to warp with. Defaults to 1 to warp in this process.
+
+        Returns:
+            iterable: The warped frames, in order
+        """
+        frames = self.profile_stream(f"{video_device}.decode", read_frames(video, output_fps, start_index, end_index))
+        if self.config.config['processing']['dedup_threshold'] > 0:
+            frames = self.profile_stream(f"{video_device}.dedup", skip_unchanged_frames(frames, self.config.config['processing']['dedup_threshold']))
+        warped_frames = self.profile_stream(f"{video_device}.warp", self.warp_frames(frames, video_device, workers, output_fps))
+        if self.config.config['processing']['slides']:
+            warped_frames = self.profile_stream(f"{video_device}.slides", self.save_slides(warped_frames, video_device, output_fps, start_index))
+        return self.count_frames(warped_frames, video_device)
+
+    def save_slides(self, frames, video_device: str, output_fps: float, start_index: int = 0):
+        """Passes warped frames through, saving a still image into the slides directory of the job
+        each time the board content changes and then settles
+
+        Args:
+            frames (iterable): The warped frames
+            video_device (str): The name of the video device the frames came from
+            output_fps (float): The framerate of the frames
+            start_index (int, optional): The output frame index of the first frame, used for the timestamps. Defaults to 0.
+        """
+        slides_directory = self.recording_directory.joinpath('slides')
+        slides_directory.mkdir(exist_ok=True)
+        threshold = self.config.config['processing']['slides_threshold']
+        sample_interval = max(round(output_fps), 1) # check the board about once a second
+
+        last_slide = None
+        last_sample = None
+        for index, frame in enumerate(frames, start_index):
+            if index % sample_interval == 0:
+                sample = get_thumbnail(frame)
+                # Save once the content differs from the last slide but has stopped changing
+                if last_slide is None or (frame_difference(sample, last_slide) > threshold and frame_difference(sample, last_sample) <= threshold):
+                    seconds = int(index / output_fps)
+                    cv2.imwrite(slides_directory.joinpath(f"{video_device}_{seconds // 3600:02d}-{seconds // 60 % 60:02d}-{seconds % 60:02d}.jpg").as_posix(), frame)
+                    last_slide = sample
+                last_sample = sample
+            yield frame
+
+    def warp_frames(self, frames, video_device: str, workers: int = 1, output_fps: float = None):
+        """Warps a stream of frames from the video device into the output resolution
+
+        Args:
+            frames (iterable): The frames to warp. None repeats the previous warped frame without warping again.
+            video_device (str): The name of the video device the frames came from
+            workers (int, optional): The number of processes to warp with. Defaults to 1 to warp in this process.
+            output_fps (float, optional): The framerate of the frames, needed to follow the corners if track_corners is enabled. Defaults to None.
+
+        Returns:
+            iterable: The warped frames, in order
+        """
+        output_resolution = tuple(self.config.config['processing']['output_resolution'])
+        warper = self.get_warper(video_device, output_resolution, self.config.config['processing']['warp_method'])
+
+        if workers > 1:
+            warper = parallel.ParallelWarper(warper.transform_matrix, output_resolution, warper.method, workers, self.config.config['processing']['max_frames_in_flight'])
+        elif self.config.config['processing']['track_corners'] and output_fps:
+            warper = copy.copy(warper) # the cached warper is shared, so it mustn't be changed
+
+        if self.config.config['processing']['track_corners'] and output_fps:
+            frames = self.profile_stream(f"{video_device}.track", self.track_corners(frames, video_device, output_fps, warper))
+        return warper.warp_stream(frames)
+
+    def track_corners(self, frames, video_device: str, output_fps: float, warper):
+        """Passes frames through, looking for the ArUco markers every few seconds and rebuilding the warp
+        if the camera was bumped. The warp changes from the frame the markers moved in onwards.
+
+        Args:
+            frames (iterable): The frames from the video device, where None is passed through
+            video_device (str): The name of the video device the frames came from
+            output_fps (float): The framerate of the frames
+            warper (Warper or parallel.ParallelWarper): The warper of the stream, updated with set_transform_matrix
+        """
+        processing_config = self.config.config['processing']
+        tracker = aruco.CornerTracker(self.config.config[video_device]['corners'], self.config, processing_config['track_corners_search_size'],
+                                      processing_config['track_corners_scale'], processing_config['track_corners_smoothing'],
+                                      processing_config['track_corners_threshold'], self.config.config[video_device]['marker_ids'])
+        interval = max(round(processing_config['track_corners_interval'] * output_fps), 1)
+
+        frames_since_check = interval # check the first frame
+        for frame in frames:
+            # Frames that were skipped as unchanged can't have moved
+            if frame is not None and frames_since_check >= interval:
+                frames_since_check = 0
+                if tracker.update(frame):
+                    print(f"Corners of {video_device} moved, warping with {tracker.corners.astype(float).round(1).tolist()}")
+                    warper.set_transform_matrix(self.get_warp_matrix(video_device, warper.output_size, tracker.corners.tolist()))
+            frames_since_check += 1
+            yield frame
+
+    def count_frames(self, frames, video_device: str):
+        """Passes frames through while counting them towards the progress of the video device,
+        waiting whenever processing is paused"""
+        self.frames_processed[video_device] = 0
+        self.processing_start_times[video_device] = time.time()
+        self.processing_finish_times.pop(video_device, None)
+        for frame in frames:
+            if self.running is not None:
+                self.running.wait()
+            if self.cancelled is not None and self.cancelled.is_set():
+                raise Exception('Processing was cancelled')
+            yield frame
+            self.frames_processed[video_device] += 1
+        self.processing_finish_times[video_device] = time.time()
+
+    def profile_stream(self, stage: str, frames):
+        """Times each frame of a stream under the stage name when profiling is enabled, see profiler.Profiler"""
+        if self.profiler is None:
+            return frames
+        return self.profiler.stream(stage, frames)
+
+    def measure(self, stage: str):
+        """Returns a context manager that times the code inside it under the stage name when profiling is enabled"""
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.measure(stage)
+
+    @contextlib.contextmanager
+    def profiling(self, name: str):
+        """Profiles the processing done inside a with statement when profiling is enabled, saving the
+        per-frame timings and optionally a cProfile into the profile directory of the job
+
+        Args:
+            name (str): The name of the profile files, usually the processing stage
+        """
+        if self.profiler is None:
+            yield
+            return
+        profile_directory = self.recording_directory.joinpath('profile')
+        profile_directory.mkdir(exist_ok=True)
+        self.profiler.reset()
+        # cProfile only sees the thread it was enabled in, the per-frame timings cover every thread
+        python_profile = cProfile.Profile() if self.config.config['processing']['cprofile'] else None
+        if python_profile is not None:
+            python_profile.enable()
+        try:
+            yield
+        finally:
+            if python_profile is not None:
+                python_profile.disable()
+                python_profile.dump_stats(profile_directory.joinpath(f"{name}.prof").as_posix())
+            if self.profiler.stages:
+                self.profiler.print_summary(name)
+                self.profiler.save(profile_directory.joinpath(f"{name}.json"))
+
+    def get_progress(self) -> float:
+        """Returns the fraction of frames processed so far across all the video devices, between 0 and 1"""
+        # Copied first, since the processing threads add video devices while this runs
+        frames_total = sum(dict(self.frames_total).values())
+        if frames_total == 0:
+            return 0
+        return min(sum(dict(self.frames_processed).values()) / frames_total, 1)
+
+    def get_progress_details(self) -> dict:
+        """Returns the frames processed, total frames and processing speed of each video device,
+        along with the overall speed and estimated seconds remaining"""
+        video_devices = {}
+        seconds_remaining = 0
+        # Copied first, since the processing threads add video devices while this runs
+        frames_processed_by_device = dict(self.frames_processed)
+        start_times = dict(self.processing_start_times)
+        finish_times = dict(self.processing_finish_times)
+        for video_device, frames_total in dict(self.frames_total).items():
+            frames_processed = frames_processed_by_device.get(video_device, 0)
+            elapsed = finish_times.get(video_device, time.time()) - start_times.get(video_device, time.time())
+            fps = frames_processed / elapsed if elapsed > 0 else 0
+            video_devices[video_device] = {
+                'frames_processed': frames_processed,
+                'frames_total': frames_total,
+                'fps': round(fps, 2),
+            }
+            # The video devices are processed side by side, so the slowest one decides when processing finishes
+            if fps > 0:
+                seconds_remaining = max(seconds_remaining, max(frames_total - frames_processed, 0) / fps)
+            elif frames_processed < frames_total:
+                seconds_remaining = None
+                break
+
+        return {
+            'video_devices': video_devices,
+            'fps': round(sum(video_device['fps'] for video_device in video_devices.values()), 2),
+            'eta': round(seconds_remaining) if seconds_remaining is not None else None,
+            'ffmpeg_progress': self.ffmpeg_progress,
+        }
+
+    def run_ffmpeg(self, ffmpeg_command: list[str], duration: float) -> int:
+        """Runs an ffmpeg command, following its progress through ffmpeg_progress
+
+        Args:
+            ffmpeg_command (list[str]): The ffmpeg command, starting with 'ffmpeg'
+            duration (float): The expected duration of the output in seconds
+
+        Returns:
+            int: The return code of ffmpeg
+        """
+        self.ffmpeg_progress = 0
+        process = subprocess.Popen([ffmpeg_command[0], '-progress', 'pipe:1', '-nostats', *ffmpeg_command[1:]], stdout=subprocess.PIPE)
+        # ffmpeg writes blocks of key=value lines, out_time_us is how far through the output it is
+        for line in process.stdout:
+            key, _, value = line.decode('utf-8').strip().partition('=')
+            if key == 'out_time_us' and value.isdigit() and duration > 0:
+                self.ffmpeg_progress = min(int(value) / 1000000 / duration, 1)
+            elif key == 'progress' and value == 'end':
+                self.ffmpeg_progress = 1
+        return process.wait()
+
+    def get_concurrent_video_device_count(self) -> int:
+        """Returns how many video devices may be processed at the same time"""
+        return max(int(self.config.config['processing']['concurrent_video_devices']), 1)
+
+    def get_worker_count(self) -> int:
+        """Returns the number of processes to warp frames with"""
+        workers = int(self.config.config['processing']['workers'])
+        if workers <= 0: # automatic
+            workers = os.cpu_count() or 1
+        return workers
+
+    def get_stacked_video_devices(self) -> list[str]:
+        """Returns the enabled video devices in the order they should be stacked in the output video"""
+        video_devices = self.config.get_enabled_video_devices()
+        if len(video_devices) == 2:
+            stack_order = self.config.config['stack_order'] # list like [0, 1] or [1, 0] defining which video is first
+            video_devices = [video_devices[i] for i in stack_order]
+        return video_devices
+
+    def get_stacked_frame_size(self, video_device_count: int) -> tuple:
+        """Returns the (width, height) of the output video with the given number of cameras stacked"""
+        width, height = self.config.config['processing']['output_resolution']
+        if self.config.config['stack'] == 'hstack':
+            return (width * video_device_count, height)
+        return (width, height * video_device_count)
+
+    def stack_frames(self, frames: list[np.ndarray]) -> np.ndarray:
+        """Stacks the warped frames from each camera horizontally or vertically"""
+        if len(frames) == 1:
+            return frames[0]
+        if self.config.config['stack'] == 'hstack':
+            return np.hstack(frames)
+        return np.vstack(frames)
+
     def process_video(self, input_file, output_file, video_device):
         # Create the video capture and get its properties
         video = cv2.VideoCapture(input_file)
         video_fps = video.get(cv2.CAP_PROP_FPS)
         video_framecount = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.frames_total[video_device] = video_framecount
 
         # Create the video writer
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        out_file = cv2.VideoWriter(output_file, fourcc, video_fps, (1920, 1080))
+        output_resolution = tuple(self.config.config['processing']['output_resolution'])
+        out_file = FFmpegWriter(output_file, output_resolution, video_fps, get_video_codec_args(self.config))
 
         # Testing purposes
         processing_start_time = time.time()
 
-        self.transform_matrix = self.get_warp_matrix(video_device)
-
-        counter = 0
-        while video.isOpened():
-            if counter > video_framecount:
-                break
-
-            ret, frame = video.read()
-            if not ret:
-                print("ret false") # Shouldn't happen but sometimes does
-            else:
-                # Replace the frame with the birds eye view
-                output = self.birds_eye_view(frame, video_device)
-                output = cv2.resize(output, (1920, 1080), interpolation=cv2.INTER_AREA) # apparently necessary on linux???
+        # Sample each frame once, straight into the output resolution
+        for output in self.get_warped_stream(video, video_device, video_fps):
+            with self.measure(f"{video_device}.write"):
                 out_file.write(output)
-                
-            counter += 1
 
         video.release()
         out_file.release()
@@ -80,51 +610,90 @@ class Processing():
         # Get the file paths
         temp_processed_video_files = [self.recording_directory.joinpath(self.config.config[video_device]['temp_processed_video_file']).as_posix() for video_device in self.config.get_enabled_video_devices()]
         # stacked_video_file = self.config.config['files']['stacked_video_file']
-        temp_audio_file = self.recording_directory.joinpath(self.config.config['files']['temp_audio_file']).as_posix()
+        audio_source = self.get_audio_source()
         
         # output_video_file = self.recording_directory.joinpath(self.config.config['files']['output_video_file']).as_posix()
         output_video_file = self.recording_directory.joinpath(f"{self.job_name}.mp4").as_posix()
+        output_fps, frame_count = self.get_output_timing()
+        duration = frame_count / output_fps if output_fps else 0
 
         # If there is only one video device, just use the processed video file as the output video file
         if len(temp_processed_video_files) == 1:
             # Use ffmpeg to combine the new silent video with the audio from the original video
-            subprocess.run(['ffmpeg','-hide_banner','-y',
-                            '-i', temp_audio_file, '-i',temp_processed_video_files[0],'-err_detect','ignore_err',
-                            '-codec:a', 'copy', '-codec:v','copy',
-                            output_video_file])
+            self.run_ffmpeg(['ffmpeg','-hide_banner','-y',
+                             '-i', audio_source, '-i',temp_processed_video_files[0],'-err_detect','ignore_err',
+                             '-map', '1:v:0', '-map', '0:a:0?',
+                             *get_audio_codec_args(audio_source), '-codec:v','copy',
+                             output_video_file], duration)
             return
 
         stack_order = self.config.config['stack_order'] # list like [0, 1] or [1, 0] defining which video is first
         # Use ffmpeg to stack the processed videos on top of each other
-        subprocess.run(['ffmpeg','-hide_banner','-y',
-                        '-i', temp_processed_video_files[stack_order[0]],'-i',temp_processed_video_files[stack_order[1]], # might rely on alphabetical order
-                        '-i', temp_audio_file,
-                        '-err_detect','ignore_err',
-                        '-filter_complex', self.config.config['stack'], # stack the videos horizontally or vertically
-                        '-r', str(max(int(self.config.config['video0']['framerate']), int(self.config.config['video1']['framerate']))), # choose the highest framerate of the two videos
-                        output_video_file])
-
-    def get_warp_matrix(self, video_device='video0'):
+        self.run_ffmpeg(['ffmpeg','-hide_banner','-y',
+                         '-i', temp_processed_video_files[stack_order[0]],'-i',temp_processed_video_files[stack_order[1]], # might rely on alphabetical order
+                         '-i', audio_source,
+                         '-err_detect','ignore_err',
+                         '-filter_complex', f"[0:v][1:v]{self.config.config['stack']}[stacked]", # stack the videos horizontally or vertically
+                         '-map', '[stacked]', '-map', '2:a:0?',
+                         *get_video_codec_args(self.config), *get_audio_codec_args(audio_source),
+                         '-r', str(max(int(self.config.config['video0']['framerate']), int(self.config.config['video1']['framerate']))), # choose the highest framerate of the two videos
+                         output_video_file], duration)
+
+    def get_warp_matrix(self, video_device='video0', output_size=(1000, 1000), corners=None):
+        """
+        Computes the perspective transform from the configured corners of the video device directly
+        to the given output size, so that no further resizing is needed after warping.
+
+        Args:
+            video_device (str): The name of the video device to use for configuration.
+            output_size (tuple): The (width, height) of the warped image.
+            corners (list, optional): Corners to use instead of the configured ones. Defaults to None.
+
+        Returns:
+            numpy.ndarray: The 3x3 perspective transform matrix.
+        """
         # Corners should be in this order
         # 0 1
         # 2 3
 
-        corners = self.config.config[video_device]['corners']
+        if corners is None:
+            corners = self.config.config[video_device]['corners']
         # Make a copy of the corners
-        corners = corners.copy()
+        corners = list(corners)
         corners[2], corners[3] = corners[3], corners[2]
 
+        width, height = output_size
         init_corners = np.array(corners, dtype="float32")  # initial corners from the arguments
-        dest_corners = np.array([[0, 0], [1000, 0], [1000, 1000], [0, 1000]],
-                                dtype="float32")  # destination corners in a square
+        dest_corners = np.array([[0, 0], [width, 0], [width, height], [0, height]],
+                                dtype="float32")  # destination corners filling the output image
 
-        # Compute the perspective transform matrix and then apply it
+        # Compute the perspective transform matrix
         transform_matrix = cv2.getPerspectiveTransform(init_corners, dest_corners)
         return transform_matrix
 
+    def get_warper(self, video_device: str, output_size: tuple, method: str = 'remap') -> 'Warper':
+        """
+        Returns a Warper for the configured corners of the video device, reusing the one built last time
+        unless the corners, output size or method changed. Building the remap tables takes far longer than
+        warping a frame, so previews and jobs for the same camera share them.
+
+        Args:
+            video_device (str): The name of the video device to use for configuration.
+            output_size (tuple): The (width, height) of the warped image.
+            method (str, optional): The warp method, see Warper. Defaults to 'remap'.
+
+        Returns:
+            Warper: The warper, which is safe to use from several threads at once.
+        """
+        key = (video_device, tuple(tuple(corner) for corner in self.config.config[video_device]['corners']), tuple(output_size), method)
+        with _warper_cache_lock:
+            if key not in _warper_cache:
+                _warper_cache[key] = Warper(self.get_warp_matrix(video_device, output_size), output_size, method)
+            return _warper_cache[key]
+
     def birds_eye_view(self, img, video_device='video0'):
             """
-            Applies a perspective transform to the input image to obtain a bird's eye view.
+            Applies a perspective transform to the input image to obtain a bird's eye view, at the video device's resolution.
             
             Args:
                 img (numpy.ndarray): The input image to transform.
@@ -133,23 +702,390 @@ class Processing():
             Returns:
                 numpy.ndarray: The transformed image with a bird's eye view.
             """
-            warped = cv2.warpPerspective(img, self.transform_matrix, (1000, 1000))
-
             # Uncomment to draw the corners for debugging
             # for corner in corners:
             #     img = cv2.circle(img, corner, 10, (0, 0, 255), -1)
 
-            resized = cv2.resize(warped, self.config.config[video_device]['resolution'], interpolation=cv2.INTER_AREA)
+            return self.get_warper(video_device, tuple(self.config.config[video_device]['resolution'])).warp(img)
+
+class Warper():
+    def __init__(self, transform_matrix: np.ndarray, output_size: tuple, method: str = 'remap'):
+        """Warps frames with a fixed perspective transform, sampling each output pixel exactly once
+
+        Args:
+            transform_matrix (np.ndarray): The perspective transform from the input frame to the output frame
+            output_size (tuple): The (width, height) of the output frame
+            method (str, optional): 'remap' to build lookup tables once and reuse them for every frame,
+                or 'perspective' to use cv2.warpPerspective. Defaults to 'remap'.
+        """
+        if method not in ['remap', 'perspective']:
+            raise ValueError(f"Unknown warp method {method}")
+
+        self.transform_matrix = transform_matrix
+        self.output_size = tuple(output_size)
+        self.method = method
+        if method == 'remap':
+            self.map1, self.map2 = build_remap_tables(transform_matrix, self.output_size)
+
+    def set_transform_matrix(self, transform_matrix: np.ndarray):
+        """Changes the perspective transform of the frames warped from now on. Warpers from
+        Processing.get_warper are shared, so only call this on a copy of them."""
+        self.transform_matrix = transform_matrix
+        if self.method == 'remap':
+            self.map1, self.map2 = build_remap_tables(transform_matrix, self.output_size)
+
+    def warp(self, frame: np.ndarray, output: np.ndarray = None) -> np.ndarray:
+        """Warps a single frame into the output size
+
+        Args:
+            frame (np.ndarray): The frame to warp
+            output (np.ndarray, optional): An existing array to write the warped frame into. Defaults to None.
+
+        Returns:
+            np.ndarray: The warped frame
+        """
+        if self.method == 'remap':
+            return cv2.remap(frame, self.map1, self.map2, cv2.INTER_LINEAR, dst=output)
+        return cv2.warpPerspective(frame, self.transform_matrix, self.output_size, dst=output)
+
+    def warp_stream(self, frames):
+        """Warps every frame from an iterable, repeating the previous warped frame for each None
+
+        Args:
+            frames (iterable): The frames to warp
+
+        Yields:
+            numpy.ndarray: The warped frames in order
+        """
+        warped = None
+        for frame in frames:
+            if frame is not None:
+                warped = self.warp(frame)
+            yield warped
 
-            return resized
+def clear_warper_cache(video_device: str = None):
+    """Forgets the warpers of the video device, or of every video device if None. Call this when the
+    corners change, so the remap tables for the old corners don't stay in memory."""
+    with _warper_cache_lock:
+        for key in list(_warper_cache):
+            if video_device is None or key[0] == video_device:
+                del _warper_cache[key]
+
+def skip_unchanged_frames(frames, threshold: float):
+    """Replaces frames that are nearly identical to the last changed frame with None, so that
+    the warp can be skipped and the previous warped frame reused
+
+    Args:
+        frames (iterable): The frames to check, where None is passed through
+        threshold (float): The mean absolute difference (0-255) of the downscaled grayscale frames, in the region that changed the most, above which a frame counts as changed
+
+    Yields:
+        numpy.ndarray: The frame if it changed, otherwise None
+    """
+    last_thumbnail = None
+    for frame in frames:
+        if frame is None:
+            yield None
+            continue
+        thumbnail = get_thumbnail(frame)
+        if last_thumbnail is None or region_difference(thumbnail, last_thumbnail) > threshold:
+            last_thumbnail = thumbnail
+            yield frame
+        else:
+            yield None
+
+def get_thumbnail(frame: np.ndarray, width: int = 160) -> np.ndarray:
+    """Returns a small grayscale copy of the frame for cheap change detection"""
+    height = max(round(frame.shape[0] * width / frame.shape[1]), 1)
+    return cv2.cvtColor(cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+
+def frame_difference(thumbnail: np.ndarray, other_thumbnail: np.ndarray) -> float:
+    """Returns the mean absolute difference between two thumbnails, from 0 to 255"""
+    return float(cv2.absdiff(thumbnail, other_thumbnail).mean())
+
+def region_difference(thumbnail: np.ndarray, other_thumbnail: np.ndarray, regions: int = 16) -> float:
+    """Returns the mean absolute difference between two thumbnails in the region that changed the most, from 0 to 255.
+    A few new words on a large board barely move the mean over the whole frame, but stand out within their region.
+
+    Args:
+        thumbnail (numpy.ndarray): The thumbnail to compare
+        other_thumbnail (numpy.ndarray): The thumbnail to compare against
+        regions (int, optional): The number of regions across the width of the thumbnail. Defaults to 16.
+    """
+    difference = cv2.absdiff(thumbnail, other_thumbnail).astype(np.float32)
+    height = max(round(difference.shape[0] * regions / difference.shape[1]), 1)
+    return float(cv2.resize(difference, (regions, height), interpolation=cv2.INTER_AREA).max())
+
+def build_remap_tables(transform_matrix: np.ndarray, output_size: tuple):
+    """Precomputes the cv2.remap lookup tables equivalent to cv2.warpPerspective with the given matrix
+
+    Args:
+        transform_matrix (np.ndarray): The perspective transform from the input frame to the output frame
+        output_size (tuple): The (width, height) of the output frame
+
+    Returns:
+        tuple: The fixed-point (map1, map2) pair to pass to cv2.remap
+    """
+    width, height = output_size
+    # Every output pixel looks up its source position through the inverse transform
+    xs, ys = np.meshgrid(np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32))
+    destination_points = np.stack([xs, ys], axis=-1).reshape(-1, 1, 2)
+    source_points = cv2.perspectiveTransform(destination_points, np.linalg.inv(transform_matrix))
+    source_map = source_points.reshape(height, width, 2)
+
+    # Fixed-point maps are considerably faster for cv2.remap than floating-point ones
+    return cv2.convertMaps(source_map, None, cv2.CV_16SC2)
+
+def _init_segment_worker(running):
+    """Keeps the pause event of the job in the worker processes of Processing.process_recording_segmented"""
+    global _segment_running
+    _segment_running = running
+
+def _process_segment(config, recording_directory: pathlib.Path, job_name: str, start_index: int, end_index: int, segment_file: pathlib.Path):
+    """Entry point for the worker processes of Processing.process_recording_segmented"""
+    video_processing = Processing(config, recording_directory, job_name)
+    video_processing.running = _segment_running
+    video_processing.process_segment(start_index, end_index, segment_file)
+
+def get_segment_pattern(recording_file: pathlib.Path) -> pathlib.Path:
+    """Returns the file name pattern ffmpeg writes the segments of a segmented recording to, such as temp_video0_00001.mkv"""
+    return recording_file.with_name(f"{recording_file.stem}_%05d{recording_file.suffix}")
+
+def get_segment_manifest(recording_file: pathlib.Path) -> pathlib.Path:
+    """Returns the CSV file ffmpeg lists each finished segment of a segmented recording in"""
+    return recording_file.with_suffix('.csv')
+
+def read_segment_manifest(manifest_file: pathlib.Path) -> list[tuple]:
+    """Reads the finished segments of a segmented recording
+
+    Args:
+        manifest_file (pathlib.Path): The manifest written by the ffmpeg segment muxer
+
+    Returns:
+        list[tuple]: The (file name, start, end) of each finished segment in order, with the times in seconds
+    """
+    segments = []
+    with open(manifest_file, 'r', newline='') as file:
+        for row in csv.reader(file):
+            if len(row) < 3: # a line cut off by a crash
+                continue
+            segments.append((row[0], float(row[1]), float(row[2])))
+    return segments
+
+def write_segment_concat_list(recording_file: pathlib.Path) -> pathlib.Path:
+    """Lists the finished segments of a segmented recording in a concat file that ffmpeg and OpenCV can
+    open like a single video. The durations are included so the length of the whole recording is known
+    without reading every segment.
+
+    Args:
+        recording_file (pathlib.Path): The path of the recording without segments, such as temp_video0.mkv
+
+    Returns:
+        pathlib.Path: The path of the concat file
+    """
+    concat_list_file = recording_file.with_suffix('.ffconcat')
+    with open(concat_list_file, 'w') as file:
+        file.write('ffconcat version 1.0\n')
+        for segment_file, start, end in read_segment_manifest(get_segment_manifest(recording_file)):
+            file.write(f"file '{segment_file}'\nduration {round(end - start, 6)}\n")
+    return concat_list_file
+
+class FFmpegWriter():
+    def __init__(self, output_file: str, frame_size: tuple, fps: float, video_codec_args: list[str], audio_source: str = None):
+        """Encodes raw BGR frames by piping them into an ffmpeg process, like a cv2.VideoWriter
+
+        Args:
+            output_file (str): The path of the video file to write
+            frame_size (tuple): The (width, height) of the frames that will be written
+            fps (float): The framerate of the output video
+            video_codec_args (list[str]): The ffmpeg arguments for encoding the video, see get_video_codec_args
+            audio_source (str, optional): A media file to take the audio track from. Defaults to None for no audio.
+        """
+        ffmpeg_command = ['ffmpeg','-hide_banner','-y','-loglevel','error',
+                          '-f','rawvideo','-pix_fmt','bgr24','-video_size',f'{frame_size[0]}x{frame_size[1]}','-framerate',str(fps),'-i','pipe:0']
+        if audio_source is not None:
+            ffmpeg_command.extend(['-i', audio_source, '-map', '0:v:0', '-map', '1:a:0?', *get_audio_codec_args(audio_source)])
+        ffmpeg_command.extend([*video_codec_args, output_file])
+
+        self.output_file = output_file
+        self.process = subprocess.Popen(ffmpeg_command, stdin=subprocess.PIPE)
+
+    def write(self, frame: np.ndarray):
+        """Writes a single frame to the ffmpeg process"""
+        self.process.stdin.write(np.ascontiguousarray(frame).data)
+
+    def release(self):
+        """Finishes encoding and waits for ffmpeg to exit"""
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise Exception(f"ffmpeg failed to encode {self.output_file}")
+
+    def abort(self):
+        """Stops ffmpeg without finishing the video"""
+        self.process.kill()
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.process.wait()
+
+def get_video_codec_args(config, profile: str = None) -> list[str]:
+    """Returns the ffmpeg arguments for encoding video with the configured encoding profile
+
+    Args:
+        config (configuration.Configuration): The configuration
+        profile (str, optional): The encoding profile to use instead of the configured one. Defaults to None.
+    """
+    encoding_config = config.config['encoding']
+    settings = dict(ENCODING_PROFILES[profile or encoding_config['profile']])
+    # Settings given in the config override the profile
+    for setting in ['codec', 'preset', 'crf', 'tune', 'gop']:
+        if encoding_config[setting] not in ['', -1]:
+            settings[setting] = encoding_config[setting]
+
+    codec_args = ['-codec:v', settings['codec'], '-preset', str(settings['preset']), '-crf', str(settings['crf'])]
+    if settings['tune'] != '':
+        codec_args.extend(['-tune', settings['tune']])
+    codec_args.extend(['-g', str(settings['gop'])])
+    if int(encoding_config['threads']) > 0:
+        codec_args.extend(['-threads', str(encoding_config['threads'])])
+    codec_args.extend(['-pix_fmt', 'yuv420p']) # the most widely playable pixel format
+    return codec_args
+
+def get_audio_codec_args(audio_source: str) -> list[str]:
+    """Returns the ffmpeg arguments to put the audio from the source into an mp4 file, copying the
+    audio stream when its codec is supported by mp4 and otherwise transcoding it to AAC
+
+    Args:
+        audio_source (str): The media file the audio is taken from
+    """
+    try:
+        codec = subprocess.run(['ffprobe','-v','error','-select_streams','a:0','-show_entries','stream=codec_name','-of','csv=p=0',audio_source],
+                               capture_output=True).stdout.decode('utf-8').strip()
+    except FileNotFoundError: # ffprobe isn't installed
+        codec = ''
+    if codec in MP4_AUDIO_CODECS:
+        return ['-codec:a', 'copy']
+    return ['-codec:a', 'aac']
+
+def read_frames(video: cv2.VideoCapture, output_fps: float, start_index: int = 0, end_index: int = None):
+    """Reads frames from a video, repeating or dropping frames to match the output framerate
+
+    Args:
+        video (cv2.VideoCapture): The video to read from
+        output_fps (float): The framerate that frames should be yielded at
+        start_index (int, optional): The first output frame to yield, which the video is seeked to. Defaults to 0.
+        end_index (int, optional): The output frame to stop before. Defaults to None for the end of the video.
+
+    Yields:
+        numpy.ndarray: The frame to show at each output frame time
+    """
+    video_fps = video.get(cv2.CAP_PROP_FPS) or output_fps
+    video_framecount = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    frame = None
+    video_index = -1 # index of the frame currently held
+    output_index = start_index
+    if start_index > 0:
+        # OpenCV seeks to the previous keyframe and decodes up to the requested frame
+        video_index = int(start_index * video_fps / output_fps) - 1
+        video.set(cv2.CAP_PROP_POS_FRAMES, video_index + 1)
+
+    while end_index is None or output_index < end_index:
+        # Advance the video until it reaches the time of the current output frame
+        while frame is None or (video_index + 1) / video_fps <= output_index / output_fps:
+            ret, next_frame = video.read()
+            video_index += 1
+            if ret:
+                frame = next_frame
+            elif video_index >= video_framecount:
+                return
+            # Otherwise skip the unreadable frame. Shouldn't happen but sometimes does
+        yield frame
+        output_index += 1
+
+def stack_streams(streams: list):
+    """Iterates over several frame streams together until all of them are exhausted,
+    repeating the last frame of any stream that ends early
+
+    Args:
+        streams (list): The iterables of frames to combine
+
+    Yields:
+        list: One frame from each stream
+    """
+    iterators = [iter(stream) for stream in streams]
+    last_frames = [None] * len(iterators)
+    while True:
+        finished = 0
+        for i, iterator in enumerate(iterators):
+            frame = next(iterator, None)
+            if frame is None:
+                finished += 1
+            else:
+                last_frames[i] = frame
+        if finished == len(iterators) or any(frame is None for frame in last_frames):
+            return
+        yield list(last_frames)
+
+def threaded_stream(stream, max_buffered: int = 8):
+    """Runs an iterable in a background thread, buffering a limited number of items ahead of the consumer
+
+    Args:
+        stream (iterable): The iterable to run
+        max_buffered (int, optional): The most items to buffer before the background thread waits. Defaults to 8.
+
+    Yields:
+        The items from the stream, in order
+    """
+    buffer = queue.Queue(max(max_buffered, 1))
+    finished = object() # marks the end of the stream
+    stopped = threading.Event()
+
+    def put(item) -> bool:
+        # Keep checking whether the consumer has given up while waiting for room
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in stream:
+                if not put(item):
+                    return
+            put(finished)
+        except Exception as e:
+            put(e)
+        finally:
+            if hasattr(stream, 'close'):
+                stream.close()
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is finished:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stopped.set()
+        producer.join() # the producer closes the stream once it notices
 
 class Preview():
     def __init__(self, config):
         self.config = config
         self.frame = None
         self.processing = Processing(config, pathlib.Path(self.config.config['files']['recording_directory']))
+        self.captures = capture.CaptureManager(config)
 
-    def capture_frame(self, video_device='video0', attempts=10):
+    def capture_frame(self, video_device='video0'):
             """
             Captures a frame from the specified video device.
 
@@ -159,21 +1095,10 @@ class Preview():
             Returns:
                 numpy.ndarray: The captured frame as a numpy array.
             """
-            if os.name == 'nt': # windows
-                cap = cv2.VideoCapture(self.config.get_video_device_index(video_device), cv2.CAP_DSHOW) # windows is slow if you don't use dshow
-            else: # linux
-                cap = cv2.VideoCapture(self.config.get_video_device_index(video_device))
-                cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter.fourcc('m','j','p','g'))
-                cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter.fourcc('M','J','P','G'))
-            cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.config.config[video_device]['resolution'][0]) # set the X resolution
-            cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.config.config[video_device]['resolution'][1]) # set the Y resolution
-
-            for i in range(attempts):
-                ret, frame = cap.read()
-            cap.release()
-
-            if not ret:
-                print(f"Failed to capture frame from {video_device}") # if it fails after ten frames
+            # The camera is kept open between calls, so this is instant after the first frame
+            frame = self.captures.get_frame(video_device)
+            if frame is None:
+                print(f"Failed to capture frame from {video_device}")
                 return None
 
             self.frame = frame
@@ -184,8 +1109,11 @@ class Preview():
         # warped_frame = self.frame
         # for corner in self.config.config['video'+str(video_device)]['corners']:
         #     warped_frame = cv2.circle(self.frame, corner, 10, (0, 0, 255), -1)
-        self.processing.transform_matrix = self.processing.get_warp_matrix(video_device)
-        return self.processing.birds_eye_view(self.frame, video_device)
+        return self.warp(self.frame, video_device)
+
+    def warp(self, frame: np.ndarray, video_device='video0') -> np.ndarray:
+        """Returns the bird's eye view of a frame from the video device, at the video device's resolution"""
+        return self.processing.birds_eye_view(frame, video_device)
     
 def convert_to_jpeg(frame: np.ndarray):
     """Converts an OpenCV image to a jpeg
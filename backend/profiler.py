@@ -0,0 +1,114 @@
+import time
+import threading
+import json
+import pathlib
+import contextlib
+
+# Upper bounds of the histogram buckets in milliseconds, the last bucket catches everything slower
+HISTOGRAM_BUCKETS_MS = [0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+class Profiler():
+    def __init__(self):
+        """Times each step of processing per frame, such as decoding, warping and writing frames.
+        Only the time spent in a step itself is counted, not the time spent in the steps it pulls frames from,
+        so the times add up to the total and show which step is the bottleneck."""
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.local = threading.local() # each thread has its own stack of steps being timed
+
+    def start(self) -> float:
+        """Starts timing a step, returning the start time to pass to stop()"""
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        self.local.stack.append(0) # time spent in steps nested inside this one
+        return time.perf_counter()
+
+    def stop(self, stage: str, start_time: float):
+        """Stops timing a step, adding the time spent in it to the stage"""
+        elapsed = time.perf_counter() - start_time
+        nested = self.local.stack.pop()
+        if self.local.stack:
+            self.local.stack[-1] += elapsed
+        self.add(stage, elapsed - nested)
+
+    def add(self, stage: str, seconds: float):
+        """Adds one timing in seconds to a stage"""
+        milliseconds = seconds * 1000
+        bucket = next((i for i, bound in enumerate(HISTOGRAM_BUCKETS_MS) if milliseconds <= bound), len(HISTOGRAM_BUCKETS_MS))
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = {'count': 0, 'total': 0, 'min': seconds, 'max': seconds, 'histogram': [0] * (len(HISTOGRAM_BUCKETS_MS) + 1)}
+            stats = self.stages[stage]
+            stats['count'] += 1
+            stats['total'] += seconds
+            stats['min'] = min(stats['min'], seconds)
+            stats['max'] = max(stats['max'], seconds)
+            stats['histogram'][bucket] += 1
+
+    @contextlib.contextmanager
+    def measure(self, stage: str):
+        """Times the code inside a with statement"""
+        start_time = self.start()
+        try:
+            yield
+        finally:
+            self.stop(stage, start_time)
+
+    def stream(self, stage: str, items):
+        """Passes the items of an iterable through, timing how long each one takes to produce
+
+        Args:
+            stage (str): The name of the stage to add the timings to
+            items (iterable): The iterable to time, usually a stream of frames
+
+        Yields:
+            The items, unchanged
+        """
+        iterator = iter(items)
+        while True:
+            start_time = self.start()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.local.stack.pop()
+                return
+            except Exception:
+                self.local.stack.pop()
+                raise
+            self.stop(stage, start_time)
+            yield item
+
+    def get_summary(self) -> dict:
+        """Returns the count, total, mean, min and max time and the histogram of each stage, slowest stage first"""
+        summary = {}
+        with self.lock:
+            for stage, stats in sorted(self.stages.items(), key=lambda item: item[1]['total'], reverse=True):
+                summary[stage] = {
+                    'count': stats['count'],
+                    'total_seconds': round(stats['total'], 3),
+                    'mean_ms': round(stats['total'] / stats['count'] * 1000, 3),
+                    'min_ms': round(stats['min'] * 1000, 3),
+                    'max_ms': round(stats['max'] * 1000, 3),
+                    # Number of timings up to each bound in milliseconds
+                    'histogram': {f"<={bound}": count for bound, count in zip(HISTOGRAM_BUCKETS_MS, stats['histogram'])} | {'slower': stats['histogram'][-1]},
+                }
+        return summary
+
+    def print_summary(self, name: str):
+        """Prints the time spent in each stage"""
+        summary = self.get_summary()
+        total = sum(stats['total_seconds'] for stats in summary.values())
+        print(f"Profile of {name}:")
+        for stage, stats in summary.items():
+            share = stats['total_seconds'] / total * 100 if total > 0 else 0
+            print(f"  {stage}: {stats['total_seconds']}s ({round(share, 1)}%), {stats['count']} frames, mean {stats['mean_ms']}ms, max {stats['max_ms']}ms")
+
+    def save(self, output_file: pathlib.Path):
+        """Saves the summary as JSON"""
+        with open(output_file, 'w') as file:
+            json.dump(self.get_summary(), file, indent=4)
+
+    def reset(self):
+        """Clears all the timings"""
+        with self.lock:
+            self.stages = {}
@@ -2,124 +2,290 @@ import pathlib
 import time
 import subprocess
 import os
-import contextlib
-import time
-import pathlib
+import threading
+import collections
+import re
+from concurrent.futures import ThreadPoolExecutor
+import live
+import camera_controls
+import processing
+
+# Matches the key=value pairs of the progress lines ffmpeg writes to stderr while recording,
+# such as "frame=  300 fps= 30 q=-1.0 size=  2048KiB time=00:00:10.00 bitrate=1677.7kbits/s dup=1 drop=3 speed=   1x"
+PROGRESS_PATTERN = re.compile(r'(\w+)=\s*(\S+)')
+
+# Seconds without a progress line after which an ffmpeg process is considered stalled
+STALLED_TIMEOUT = 5
+
+class RecordingProcess():
+    def __init__(self, ffmpeg_command: list, video_devices: list[str], stdout=None):
+        """Runs an ffmpeg process that records from the cameras, following its framerate and the frames
+        it drops or duplicates from the progress it writes to stderr
+
+        Args:
+            ffmpeg_command (list): The ffmpeg command
+            video_devices (list[str]): The names of the video devices the process records
+            stdout (optional): Passed on to subprocess.Popen, such as subprocess.PIPE for live processing. Defaults to None.
+        """
+        self.video_devices = video_devices
+        self.started = time.time()
+        self.progress = {}
+        self.progress_time = None
+        self.log = collections.deque(maxlen=20) # the last lines ffmpeg wrote besides its progress, to tell why it failed
+        self.process = subprocess.Popen(ffmpeg_command, stdin=subprocess.PIPE, stdout=stdout, stderr=subprocess.PIPE)
+        self.thread = threading.Thread(target=self.read_stderr, daemon=True)
+        self.thread.start()
+
+    def read_stderr(self):
+        """Reads the output of ffmpeg until it exits. Progress lines end with a carriage return so they overwrite each other in a terminal."""
+        buffer = b''
+        while True:
+            data = self.process.stderr.read1(4096)
+            if not data:
+                break
+            buffer += data
+            *lines, buffer = re.split(rb'[\r\n]', buffer)
+            for line in lines:
+                self.parse_line(line.decode('utf-8', errors='replace').strip())
+
+    def parse_line(self, line: str):
+        """Keeps the latest progress from a line of ffmpeg output, passing any other lines on to the console"""
+        if line.startswith('frame='):
+            self.progress = dict(PROGRESS_PATTERN.findall(line))
+            self.progress_time = time.time()
+        elif line:
+            self.log.append(line)
+            print(line)
+
+    def get_health(self) -> dict:
+        """Returns whether the process is recording normally, along with the frames it has recorded, its
+        framerate, the frames it dropped or duplicated to keep up with the cameras and its last output"""
+        def get_number(key: str) -> float:
+            try:
+                return float(self.progress.get(key, 0))
+            except ValueError: # such as 'N/A' before the first frame
+                return 0
+
+        returncode = self.process.poll()
+        seconds_since_progress = time.time() - (self.progress_time or self.started)
+        return {
+            'video_devices': self.video_devices,
+            'running': returncode is None,
+            'returncode': returncode,
+            'healthy': returncode is None and seconds_since_progress < STALLED_TIMEOUT,
+            'seconds': round(time.time() - self.started, 1),
+            'frames': int(get_number('frame')),
+            'fps': get_number('fps'),
+            'dropped_frames': int(get_number('drop')),
+            'duplicated_frames': int(get_number('dup')),
+            'speed': self.progress.get('speed', 'N/A'),
+            'seconds_since_progress': round(seconds_since_progress, 1),
+            'log': list(self.log),
+        }
+
+    def stop(self, timeout: float):
+        """Tells ffmpeg to stop recording and waits for it to exit, terminating it if it takes longer than the timeout
+
+        Args:
+            timeout (float): The most seconds to wait for ffmpeg to stop gracefully
+        """
+        try:
+            self.process.stdin.write(str.encode('q'))
+            self.process.stdin.close()
+        except OSError as e: # ffmpeg has already exited
+            print(e)
+
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            print(f"ffmpeg recording {', '.join(self.video_devices)} didn't stop within {timeout} seconds, terminating it")
+            self.process.terminate()
+            try:
+                self.process.wait(STALLED_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.thread.join()
 
 class VideoRecorder():
     def __init__(self, config):
         self.config = config
         self.recording_processes = []
+        self.live_processors = []
+        self.camera_controls = camera_controls.CameraControls(config)
 
     def start_recording(self, recording_directory: pathlib.Path):
         # Clear any files in the recording directory
         self.clear_files(recording_directory)
+        self.live_processors = []
 
-        for video_device in self.config.get_enabled_video_devices():
-            # Get the video device config string
-            video_device_config = self.config.config[video_device]
+        if os.name not in ['nt', 'posix']:
+            raise Exception('OS not supported')
 
-            # Get the configuration values that will be reused
-            video_device_name = self.config.get_video_device_name(video_device)
-            audio_device = self.config.config['audio_device'][1] # specifically the audio device name
+        video_devices = self.config.get_enabled_video_devices()
+        # Focus the cameras and set their exposure and white balance
+        self.camera_controls.apply(video_devices)
+
+        if self.config.config['recording']['single_process'] and self.config.config['recording']['live_processing']:
+            # Live processing reads each camera's frames from its own ffmpeg process
+            print('recording.single_process is ignored because recording.live_processing is on, recording each camera in its own process')
+        elif self.config.config['recording']['single_process']:
+            # Capture every camera and the audio in one ffmpeg process, so the audio device is only opened once
+            # and all the recordings share the same clock
+            ffmpeg_command = ['ffmpeg','-hide_banner','-y']
+            output_args = []
+            for video_device in video_devices:
+                with_audio = video_device == video_devices[0] # the audio goes into the first camera's recording
+                video_input = ffmpeg_command.count('-i')
+                ffmpeg_command.extend(self.get_input_args(video_device, with_audio))
+                output_args.extend(['-map', f'{video_input}:v:0'])
+                if with_audio:
+                    # On windows the audio comes from the same dshow input as the video, on linux it is the next input
+                    output_args.extend(['-map', f'{video_input if os.name == "nt" else video_input + 1}:a:0'])
+                output_args.extend(self.get_output_args(video_device, recording_directory))
+            ffmpeg_command.extend(output_args)
+            self.recording_processes.append(RecordingProcess(ffmpeg_command, video_devices))
+            return
+
+        for video_device in video_devices:
+            # Each camera is recorded with its own copy of the audio
+            ffmpeg_command = ['ffmpeg','-hide_banner','-y', *self.get_input_args(video_device, True), *self.get_output_args(video_device, recording_directory)]
+
+            if not self.config.config['recording']['live_processing']:
+                # Run the ffmpeg command
+                self.recording_processes.append(RecordingProcess(ffmpeg_command, [video_device]))
+                continue
+
+            # Also output raw frames to be warped and encoded while recording
+            # The raw video file is still written in case live processing can't keep up
+            video_device_config = self.config.config[video_device]
             input_resolution = f"{video_device_config['resolution'][0]}x{video_device_config['resolution'][1]}"
-            framerate = video_device_config["framerate"]
+            ffmpeg_command.extend(['-map', '0:v:0', '-an', '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-video_size', input_resolution, 'pipe:1'])
+            live_processor = live.LiveProcessor(self.config, recording_directory, video_device, video_device_config['resolution'], video_device_config['framerate'])
+            recording_process = RecordingProcess(ffmpeg_command, [video_device], stdout=subprocess.PIPE)
+            live_processor.start(recording_process.process)
+            self.recording_processes.append(recording_process)
+            self.live_processors.append(live_processor)
+
+    def get_input_args(self, video_device: str, with_audio: bool) -> list[str]:
+        """Returns the ffmpeg arguments to capture from a video device
+
+        Args:
+            video_device (str): The internal name of the video device (either video0 or video1)
+            with_audio (bool): Whether to capture from the audio device too. On linux it is added as a second input.
 
-            # Create the file path for the recording
-            recording_file = recording_directory.joinpath(pathlib.Path(video_device_config['temp_video_file']))
+        Returns:
+            list[str]: The input arguments, to go after the start of the ffmpeg command
+        """
+        # Get the video device config string
+        video_device_config = self.config.config[video_device]
+
+        # Get the configuration values that will be reused
+        video_device_name = self.config.get_video_device_name(video_device)
+        audio_device = self.config.config['audio_device'][1] # specifically the audio device name
+        input_resolution = f"{video_device_config['resolution'][0]}x{video_device_config['resolution'][1]}"
+        framerate = video_device_config["framerate"]
 
+        if os.name == 'nt':
+            # Add input format and pixel format if necessary
+            format_args = []
+            if video_device_config['input_format'] != '':
+                format_args.extend(['-vcodec', video_device_config['input_format']])
+            if video_device_config['pixel_format'] != '':
+                format_args.extend(['-pixel_format', video_device_config['pixel_format']])
+
+            dshow_device = f'video={video_device_name}:audio={audio_device}' if with_audio else f'video={video_device_name}'
+            return ['-f','dshow',*format_args,'-framerate',str(framerate),'-video_size',str(input_resolution),'-i',dshow_device]
+
+        # Add input format and pixel format if necessary
+        format_args = []
+        if video_device_config['input_format'] != '':
+            format_args.extend(['-input_format', video_device_config['input_format']])
+        if video_device_config['pixel_format'] != '':
+            format_args.extend(['-pixel_format', video_device_config['pixel_format']])
+
+        input_args = ['-f','v4l2','-framerate',str(framerate),*format_args,'-err_detect','ignore_err','-video_size',str(input_resolution),'-i',str(video_device_name)]
+        if with_audio:
             # Put together the custom audio device string for linux
             linux_audio_device = f'sysdefault:CARD={self.config.config["custom_audio_device_card"]}'
             if self.config.config['custom_audio_device_dev'] != '':
                 linux_audio_device += f',DEV={self.config.config["custom_audio_device_dev"]}'
+            input_args.extend(['-f','alsa','-i',str(linux_audio_device)])
+        return input_args
 
-            # Beginning of the ffmpeg command for windows TODO: Add framerate
-            windows_command_template = ['ffmpeg','-hide_banner','-y','-f','dshow','-framerate',str(framerate),'-video_size',str(input_resolution),'-i',f'video={video_device_name}:audio={audio_device}']
-            # Beginning of the ffmpeg command for linux
-            linux_command_template = ['ffmpeg','-hide_banner','-y','-f','v4l2','-framerate',str(framerate),'-err_detect','ignore_err','-video_size',str(input_resolution),'-i',str(video_device_name),'-f','alsa','-i',str(linux_audio_device)]
-            
-            # Select the correct command template based on the OS
-            if os.name == 'nt':
-                ffmpeg_command = windows_command_template
-
-                # Add pixel format and input format if necessary
-                if video_device_config['pixel_format'] != '':
-                    ffmpeg_command.insert(5, '-pixel_format')
-                    ffmpeg_command.insert(6, video_device_config['pixel_format'])
-                if video_device_config['input_format'] != '':
-                    ffmpeg_command.insert(5, '-vcodec')
-                    ffmpeg_command.insert(6, video_device_config['input_format'])
-            elif os.name == 'posix':
-                ffmpeg_command = linux_command_template
-
-                # Add pixel format and input format if necessary
-                if video_device_config['pixel_format'] != '':
-                    ffmpeg_command.insert(5, '-pixel_format')
-                    ffmpeg_command.insert(6, video_device_config['pixel_format'])
-                if video_device_config['input_format'] != '':
-                    ffmpeg_command.insert(5, '-input_format')
-                    ffmpeg_command.insert(6, video_device_config['input_format'])
-
-                # Focus the camera
-                self.focus_camera(video_device)
-            else:
-                raise Exception('OS not supported')
-            
-            # Add stream copy if necessary
-            if video_device_config['streamcopy']:
-                ffmpeg_command.extend(['-codec:v', 'copy', '-codec:a', 'copy'])
-            
-            ffmpeg_command.append(recording_file) # Add the output file
-
-            # Run the ffmpeg command
-            self.recording_processes.append(subprocess.Popen(ffmpeg_command, stdin=subprocess.PIPE))
-
-    def stop_recording(self):
-        # Tell ffmpeg to stop recording
-        for process in self.recording_processes:
-            try:
-                process.communicate(str.encode('q'))
-            except Exception as e:
-                print(e)
-                pass
-
-        time.sleep(int(self.config.config['end_recording_delay'])) # Wait a bit to make sure ffmpeg has time to stop recording gracefully
-        # Terminate the ffmpeg processes
-        for process in self.recording_processes:
-            try:
-                process.terminate()
-            except Exception as e:
-                print(e)
-                pass
-
-    def clear_files(self, recording_directory: pathlib.Path):
-        # TODO: Support new jobs system
-        with contextlib.suppress(FileNotFoundError): # Ignore if the file doesn't exist
-            # Video files
-            for video_device in self.config.get_enabled_video_devices():
-                os.remove(recording_directory.joinpath(self.config.config[video_device]['temp_video_file']).as_posix())
-                os.remove(recording_directory.joinpath(self.config.config[video_device]['temp_processed_video_file']).as_posix())
-            # General files
-            os.remove(recording_directory.joinpath(self.config.config['files']['temp_audio_file']).as_posix())
-            os.remove(recording_directory.joinpath(self.config.config['files']['output_video_file']).as_posix())
-
-    def focus_camera(self, video_device):
-        """Sets the focus of the camera to the value specified in the config file
-        Only works on linux right now because of the v4l2-ctl command
+    def get_output_args(self, video_device: str, recording_directory: pathlib.Path) -> list:
+        """Returns the ffmpeg arguments to write the recording of a video device, in one file or in segments
 
         Args:
-            video_device (str): The internal name of the video device to focus (either video0 or video1)
-        """
-        if os.name != 'posix':
-            print('Focus not supported on this OS')
-            return
+            video_device (str): The internal name of the video device (either video0 or video1)
+            recording_directory (pathlib.Path): The directory of the recording job
 
-        video_device_name = self.config.get_video_device_name(video_device)
+        Returns:
+            list: The output arguments, ending with the output file
+        """
         video_device_config = self.config.config[video_device]
 
-        # Enable autofocus if necessary
-        if int(video_device_config['focus']) == -1:
-            subprocess.run(['v4l2-ctl', '-d', video_device_name, '-c', 'focus_automatic_continuous=1'])
+        # Create the file path for the recording
+        recording_file = recording_directory.joinpath(pathlib.Path(video_device_config['temp_video_file']))
+
+        # Add stream copy if necessary
+        if video_device_config['streamcopy']:
+            output_args = ['-codec:v', 'copy', '-codec:a', 'copy']
+        else:
+            output_args = ['-codec:a', 'aac'] # can be copied straight into the output video
+
+        segment_length = self.config.config['recording']['segment_length']
+        if segment_length > 0:
+            # Write the recording in fixed-length segments, listing each one in the manifest once it is finished,
+            # so a crash only loses the segment being written
+            if not video_device_config['streamcopy']:
+                # Segments can only be cut on a keyframe, so make sure there is one at every cut
+                output_args.extend(['-force_key_frames', f'expr:gte(t,n_forced*{segment_length})'])
+            output_args.extend(['-f', 'segment', '-segment_time', str(segment_length), '-segment_format', 'matroska', '-reset_timestamps', '1',
+                                '-segment_list', processing.get_segment_manifest(recording_file), '-segment_list_type', 'csv',
+                                processing.get_segment_pattern(recording_file)])
         else:
-            subprocess.run(['v4l2-ctl', '-d', video_device_name, '-c', 'focus_automatic_continuous=0'])
-            subprocess.run(['v4l2-ctl', '-d', video_device_name, '-c', f'focus_absolute={video_device_config["focus"]}'])
\ No newline at end of file
+            output_args.append(recording_file) # Add the output file
+        return output_args
+
+    def stop_recording(self):
+        """Stops all the ffmpeg processes at the same time, waiting for each to finish writing its recording"""
+        # Give ffmpeg as long as it needs to stop gracefully before it is terminated, up to stop_timeout seconds.
+        # end_recording_delay used to be a fixed wait, so a longer one set in an existing config is still honoured
+        timeout = max(float(self.config.config['recording']['stop_timeout']), float(self.config.config['end_recording_delay']))
+        if self.recording_processes:
+            with ThreadPoolExecutor(max_workers=len(self.recording_processes)) as executor:
+                list(executor.map(lambda recording_process: recording_process.stop(timeout), self.recording_processes))
+        self.recording_processes = []
+
+    def get_health(self) -> list[dict]:
+        """Returns the health of each ffmpeg process of the current recording, see RecordingProcess.get_health"""
+        return [recording_process.get_health() for recording_process in self.recording_processes]
+
+    def finish_live_processing(self) -> bool:
+        """Waits for live processing to finish after the recording has stopped
+
+        Returns:
+            bool: Whether every camera was processed live, so the recording doesn't need to be processed again
+        """
+        if not self.live_processors:
+            return False
+        results = [live_processor.finish() for live_processor in self.live_processors]
+        self.live_processors = []
+        return all(results)
+
+    def clear_files(self, recording_directory: pathlib.Path):
+        """Deletes the recordings and the files made from them in a recording directory, skipping any that don't exist"""
+        files = []
+        # Video files
+        for video_device in self.config.get_enabled_video_devices():
+            recording_file = recording_directory.joinpath(self.config.config[video_device]['temp_video_file'])
+            # Segments of a segmented recording
+            files.extend(recording_directory.glob(processing.get_segment_pattern(recording_file).name.replace('%05d', '*')))
+            files.extend([processing.get_segment_manifest(recording_file), recording_file.with_suffix('.ffconcat'), recording_file,
+                          recording_directory.joinpath(self.config.config[video_device]['temp_processed_video_file'])])
+        # General files
+        files.append(recording_directory.joinpath(self.config.config['files']['temp_audio_file']))
+        files.append(recording_directory.joinpath(self.config.config['files']['output_video_file']))
+        for file in files:
+            pathlib.Path(file).unlink(missing_ok=True)
@@ -0,0 +1,108 @@
+import cv2
+import threading
+import time
+
+# Separates the JPEG images of a multipart MJPEG stream
+BOUNDARY = 'frame'
+
+class PreviewStream():
+    def __init__(self, config, preview, video_device: str, view: str):
+        """Continuously captures frames from a video device and encodes them as JPEG once, for every viewer of
+        the stream to share. Frames are only captured while someone is watching.
+
+        Args:
+            config (configuration.Configuration): The configuration
+            preview (processing.Preview): The preview to take frames from
+            video_device (str): The name of the video device, either 'video0' or 'video1'
+            view (str): 'raw' for the camera's view, or 'warped' for the bird's eye view of the whiteboard
+        """
+        self.config = config
+        self.preview = preview
+        self.video_device = video_device
+        self.view = view
+        self.jpeg = None
+        self.frame_count = 0
+        self.viewers = 0
+        self.new_frame = threading.Condition()
+        self.thread = None
+
+    def capture_frames(self):
+        """Captures and encodes frames at the configured framerate until the last viewer leaves"""
+        while True:
+            start_time = time.time()
+            with self.new_frame:
+                if self.viewers == 0:
+                    self.thread = None
+                    return
+
+            frame = self.preview.captures.get_frame(self.video_device)
+            if frame is not None:
+                if self.view == 'warped':
+                    frame = self.preview.warp(frame, self.video_device)
+                jpeg = encode_jpeg(frame, self.config.config['preview']['width'], self.config.config['preview']['quality'])
+                with self.new_frame:
+                    self.jpeg = jpeg
+                    self.frame_count += 1
+                    self.new_frame.notify_all()
+            else:
+                time.sleep(1) # the camera is in use by a recording or unavailable, try again later
+
+            time.sleep(max(1 / self.config.config['preview']['fps'] - (time.time() - start_time), 0))
+
+    def stream(self):
+        """Yields the parts of a multipart/x-mixed-replace response, one JPEG per new frame, for a single viewer"""
+        with self.new_frame:
+            self.viewers += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.capture_frames, daemon=True)
+                self.thread.start()
+        try:
+            frame_count = 0
+            while True:
+                with self.new_frame:
+                    # Without a new frame, send the last one again, so writing to a viewer who left fails and ends the stream
+                    self.new_frame.wait_for(lambda: self.frame_count != frame_count, timeout=5)
+                    frame_count = self.frame_count
+                    jpeg = self.jpeg
+                if jpeg is None:
+                    yield b"\r\n" # nothing captured yet, an empty line before the next boundary is ignored by the viewer
+                    continue
+                yield (f"--{BOUNDARY}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(jpeg)}\r\n\r\n").encode('utf-8') + jpeg + b"\r\n"
+        finally:
+            # The viewer disconnected
+            with self.new_frame:
+                self.viewers -= 1
+
+class PreviewStreams():
+    def __init__(self, config, preview):
+        """Keeps one PreviewStream for each video device and view, shared by all their viewers
+
+        Args:
+            config (configuration.Configuration): The configuration
+            preview (processing.Preview): The preview to take frames from
+        """
+        self.config = config
+        self.preview = preview
+        self.streams = {}
+        self.lock = threading.Lock()
+
+    def get_stream(self, video_device: str, view: str) -> PreviewStream:
+        """Returns the stream of the video device and view, creating it if needed"""
+        with self.lock:
+            if (video_device, view) not in self.streams:
+                self.streams[(video_device, view)] = PreviewStream(self.config, self.preview, video_device, view)
+            return self.streams[(video_device, view)]
+
+def encode_jpeg(frame, width: int, quality: int) -> bytes:
+    """Scales the frame down to the given width, keeping its aspect ratio, and encodes it as a JPEG
+
+    Args:
+        frame (numpy.ndarray): The frame to encode
+        width (int): The largest width of the image, 0 to keep the frame's size
+        quality (int): The JPEG quality from 0 to 100
+    """
+    if 0 < width < frame.shape[1]:
+        height = round(frame.shape[0] * width / frame.shape[1])
+        frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+    ret, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+    return buffer.tobytes()
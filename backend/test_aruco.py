@@ -0,0 +1,55 @@
+import cv2
+import numpy as np
+import aruco
+
+def draw_markers(markers: dict, width: int = 1920, height: int = 1080, blur: bool = False) -> np.ndarray:
+    """Returns a white frame with the ArUco markers drawn on it, given as {id: (x, y, size)}"""
+    dictionary = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_4X4_50)
+    frame = np.full((height, width), 255, np.uint8)
+    for marker_id, (x, y, size) in markers.items():
+        frame[y:y + size, x:x + size] = cv2.aruco.generateImageMarker(dictionary, marker_id, size)
+    if blur:
+        frame = cv2.GaussianBlur(frame, (3, 3), 0)
+    return cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+
+# Two whiteboards side by side with their markers, and two stray markers in between
+TWO_BOARDS = {0: (50, 50, 100), 1: (800, 50, 100), 2: (50, 900, 100), 3: (800, 900, 100),
+              4: (1000, 60, 100), 5: (1750, 60, 100), 6: (1000, 920, 100), 7: (1750, 920, 100),
+              8: (900, 500, 100), 12: (1300, 500, 100)}
+# The outer corners of the right whiteboard's markers
+RIGHT_CORNERS = [[1000, 60], [1850, 60], [1000, 1020], [1850, 1020]]
+
+def test_tracker_follows_its_own_whiteboard(config):
+    frame = draw_markers(TWO_BOARDS)
+    # The corners are far from every marker, so only the whole frame search can find them
+    far_corners = [[500, 400], [1400, 420], [500, 700], [1400, 680]]
+    tracker = aruco.CornerTracker(far_corners, config, search_size=0.05, marker_ids=[4, 5, 6, 7])
+    np.testing.assert_allclose(tracker.find_corners(frame), RIGHT_CORNERS, atol=1)
+
+def test_tracker_learns_its_whiteboard_from_the_first_marker_near_a_corner(config):
+    frame = draw_markers(TWO_BOARDS)
+    tracker = aruco.CornerTracker(RIGHT_CORNERS, config)
+    np.testing.assert_allclose(tracker.find_corners(frame), RIGHT_CORNERS, atol=1)
+    assert tracker.marker_ids == [4, 5, 6, 7]
+
+def test_tracker_without_marker_ids_skips_the_whole_frame_search(config):
+    # Without knowing its whiteboard, the tracker could jump to the other one
+    frame = draw_markers(TWO_BOARDS)
+    tracker = aruco.CornerTracker([[500, 400], [1400, 420], [500, 700], [1400, 680]], config, search_size=0.05)
+    assert tracker.find_corners(frame) == [None] * 4
+    assert tracker.marker_ids is None
+
+def test_get_markers_looks_again_at_full_resolution_for_missing_markers(config):
+    # The blurred small marker is lost in the half resolution frame, but found in the full resolution one
+    frame = draw_markers({0: (100, 100, 120), 1: (1700, 100, 120), 2: (100, 900, 120), 3: (1751, 951, 19)}, blur=True)
+    config.config['aruco']['detection_scale'] = 0.5
+    assert len(aruco.get_markers(frame, config)[1]) == 3
+    bounding_boxes, ids = aruco.get_markers(frame, config, expected=4)
+    assert sorted(ids.flatten()) == [0, 1, 2, 3]
+    assert len(bounding_boxes) == 4
+
+def test_set_video_corners_finds_small_markers(config):
+    frame = draw_markers({4: (100, 100, 120), 5: (1700, 100, 120), 6: (100, 900, 120), 7: (1751, 951, 19)}, blur=True)
+    aruco.set_video_corners('video0', frame, config)
+    assert config.config['video0']['marker_ids'] == [4, 5, 6, 7]
+    np.testing.assert_allclose(config.config['video0']['corners'], [[100, 100], [1819, 100], [100, 1019], [1769, 969]], atol=2)
@@ -0,0 +1,89 @@
+import pytest
+import camera_controls
+
+# Output of v4l2-ctl --list-ctrls for a camera on an older kernel, which uses the old control names
+LIST_CTRLS_OUTPUT = '''
+User Controls
+
+                     brightness 0x00980900 (int)    : min=-64 max=64 step=1 default=0 value=0
+ white_balance_temperature_auto 0x0098090c (bool)   : default=1 value=1
+      white_balance_temperature 0x0098091a (int)    : min=2800 max=6500 step=1 default=4600 value=4600 flags=inactive
+           power_line_frequency 0x00980918 (menu)   : min=0 max=2 default=1 value=1 (50 Hz)
+
+Camera Controls
+
+                  exposure_auto 0x009a0901 (menu)   : min=0 max=3 default=3 value=3 (Aperture Priority Mode)
+              exposure_absolute 0x009a0902 (int)    : min=1 max=5000 step=1 default=157 value=157 flags=inactive
+'''
+
+def test_parse_controls():
+    assert camera_controls.parse_controls(LIST_CTRLS_OUTPUT) == {
+        'brightness': 0,
+        'white_balance_temperature_auto': 1,
+        'white_balance_temperature': 4600,
+        'power_line_frequency': 1,
+        'exposure_auto': 3,
+        'exposure_absolute': 157,
+    }
+
+def test_parse_controls_of_a_newer_kernel():
+    output = ('        focus_automatic_continuous 0x009a090c (bool)   : default=1 value=0\n'
+              '                    focus_absolute 0x009a090a (int)    : min=0 max=255 step=5 default=0 value=-5 flags=inactive\n')
+    assert camera_controls.parse_controls(output) == {'focus_automatic_continuous': 0, 'focus_absolute': -5}
+
+def test_get_controls(config):
+    controls = camera_controls.CameraControls(config)
+    assert controls.get_controls('video0') == [{'focus_automatic_continuous': 1, 'auto_exposure': 3, 'white_balance_automatic': 1}, {}]
+
+    config.config['video0'].update({'focus': 30, 'exposure': 100, 'white_balance': 4000})
+    assert controls.get_controls('video0') == [{'focus_automatic_continuous': 0, 'auto_exposure': 1, 'white_balance_automatic': 0},
+                                               {'focus_absolute': 30, 'exposure_time_absolute': 100, 'white_balance_temperature': 4000}]
+
+@pytest.fixture
+def camera(monkeypatch):
+    """Fakes a camera with the controls from LIST_CTRLS_OUTPUT, recording each set of controls written to it"""
+    camera = {'values': camera_controls.parse_controls(LIST_CTRLS_OUTPUT), 'reads': 0, 'writes': [], 'failing': set()}
+    def get_values(self, video_device_name):
+        camera['reads'] += 1
+        return dict(camera['values'])
+    def set_controls(self, video_device_name, controls):
+        camera['writes'].append(controls)
+        if camera['failing'] & set(controls):
+            return False
+        camera['values'].update(controls)
+        return True
+    monkeypatch.setattr(camera_controls.CameraControls, 'get_values', get_values)
+    monkeypatch.setattr(camera_controls.CameraControls, 'set_controls', set_controls)
+    return camera
+
+def test_apply_only_writes_controls_that_differ(config, camera):
+    controls = camera_controls.CameraControls(config)
+    controls.apply_controls('video0')
+    # Every automatic mode is already on, and the camera has no focus controls
+    assert camera['writes'] == []
+
+    config.config['video0'].update({'focus': 30, 'exposure': 100})
+    controls.apply_controls('video0')
+    # The modes are set before the values that need them, with the camera's names for the controls
+    assert camera['writes'] == [{'exposure_auto': 1}, {'exposure_absolute': 100}]
+
+def test_apply_reads_the_controls_every_time(config, camera):
+    config.config['video0']['exposure'] = 100
+    controls = camera_controls.CameraControls(config)
+    controls.apply_controls('video0')
+    # Another program, or replugging the camera, puts it back in automatic mode
+    camera['values'].update({'exposure_auto': 3, 'exposure_absolute': 157})
+    camera['writes'].clear()
+
+    controls.apply_controls('video0')
+    assert camera['reads'] == 2
+    assert camera['writes'] == [{'exposure_auto': 1}, {'exposure_absolute': 100}]
+
+def test_apply_sets_the_other_controls_when_one_fails(config, camera):
+    config.config['video0'].update({'exposure': 100, 'white_balance': 4000})
+    camera['failing'].add('white_balance_temperature')
+
+    camera_controls.CameraControls(config).apply_controls('video0')
+    assert camera['writes'][-3:] == [{'exposure_absolute': 100, 'white_balance_temperature': 4000},
+                                     {'exposure_absolute': 100}, {'white_balance_temperature': 4000}]
+    assert camera['values']['exposure_absolute'] == 100
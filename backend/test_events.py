@@ -0,0 +1,35 @@
+import json
+import events
+
+def test_format_event():
+    message = events.format_event('jobs', [{'name': 'lecture', 'finished': False}])
+    assert message == 'event: jobs\ndata: [{"name": "lecture", "finished": false}]\n\n'
+
+def test_format_event_keeps_the_data_on_one_line():
+    # A newline in the data would end the data field early
+    message = events.format_event('jobs', {'message': 'Failed: line one\nline two'})
+    lines = message.split('\n')
+    assert lines[0] == 'event: jobs'
+    assert json.loads(lines[1].removeprefix('data: ')) == {'message': 'Failed: line one\nline two'}
+    assert lines[2:] == ['', '']
+
+def test_publish_reaches_every_subscriber():
+    broadcaster = events.EventBroadcaster()
+    assert not broadcaster.has_subscribers()
+    first, second = broadcaster.subscribe(), broadcaster.subscribe()
+    broadcaster.publish('recording_status', {'recording_status': True})
+    expected = events.format_event('recording_status', {'recording_status': True})
+    assert first.get_nowait() == expected
+    assert second.get_nowait() == expected
+
+    broadcaster.unsubscribe(first)
+    broadcaster.publish('recording_status', {'recording_status': False})
+    assert first.empty()
+    assert not second.empty()
+
+def test_publish_drops_events_for_a_subscriber_that_stopped_reading():
+    broadcaster = events.EventBroadcaster(max_queued_events=2)
+    subscriber = broadcaster.subscribe()
+    for i in range(5):
+        broadcaster.publish('jobs', i)
+    assert [subscriber.get_nowait() for i in range(subscriber.qsize())] == [events.format_event('jobs', 0), events.format_event('jobs', 1)]
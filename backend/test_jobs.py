@@ -0,0 +1,153 @@
+import json
+import pathlib
+import time
+import pytest
+import jobs
+
+def make_job(config, job_name: str = 'lecture', **kwargs) -> jobs.ProcessingJob:
+    recording_directory = pathlib.Path(config.config['files']['recording_directory']).joinpath(job_name)
+    recording_directory.mkdir(parents=True, exist_ok=True)
+    return jobs.ProcessingJob(config, job_name, recording_directory, **kwargs)
+
+def read_journal(job: jobs.ProcessingJob) -> list[dict]:
+    with open(job.recording_directory.joinpath(jobs.JOURNAL_FILE), 'r') as file:
+        return [json.loads(line) for line in file]
+
+@pytest.fixture
+def submitted(monkeypatch):
+    """Returns a function listing the jobs queued on a job manager's scheduler, which doesn't process them"""
+    monkeypatch.setattr(jobs.JobScheduler, 'work', lambda self: None)
+    def submitted(job_manager: jobs.JobManager) -> list:
+        return [job for priority, sequence, job in job_manager.scheduler.job_queue.queue]
+    return submitted
+
+def test_new_job_is_journaled(config):
+    job = make_job(config, live_processed=True, created=1000.0)
+    entries = read_journal(job)
+    assert [entry['event'] for entry in entries] == ['created']
+    assert entries[0]['job_name'] == 'lecture' and entries[0]['live_processed'] and entries[0]['created'] == 1000.0
+
+    loaded = jobs.ProcessingJob.load(config, job.recording_directory)
+    assert (loaded.job_name, loaded.live_processed, loaded.created) == ('lecture', True, 1000.0)
+    assert not loaded.queued and not loaded.finished and loaded.completed_stages == []
+    # Loading doesn't journal the job a second time
+    assert len(read_journal(job)) == 1
+
+def test_load_restores_progress(config):
+    job = make_job(config)
+    job.record('queued')
+    job.record('stage', stage='process_recording', seconds=12.5)
+    loaded = jobs.ProcessingJob.load(config, job.recording_directory)
+    assert loaded.queued and not loaded.finished
+    assert loaded.completed_stages == ['process_recording']
+    assert loaded.stage_times == {'process_recording': 12.5}
+
+    job.record('stage', stage='stack_processed_videos', seconds=3)
+    job.record('finished')
+    loaded = jobs.ProcessingJob.load(config, job.recording_directory)
+    assert loaded.finished and loaded.started
+    assert loaded.progress_message == 'Finished'
+
+def test_load_skips_a_line_cut_off_by_a_crash(config):
+    job = make_job(config)
+    job.record('queued')
+    with open(job.recording_directory.joinpath(jobs.JOURNAL_FILE), 'a') as file:
+        file.write('{"event": "stage", "stage": "proc')
+
+    loaded = jobs.ProcessingJob.load(config, job.recording_directory)
+    assert loaded.queued and loaded.completed_stages == []
+    # The next event starts on a line of its own
+    loaded.record('finished')
+    assert jobs.ProcessingJob.load(config, job.recording_directory).finished
+
+def test_load_ignores_removed_jobs(config):
+    job = make_job(config)
+    job.record('removed')
+    assert jobs.ProcessingJob.load(config, job.recording_directory) is None
+
+def test_load_recording_without_journal(config):
+    recording_directory = pathlib.Path(config.config['files']['recording_directory']).joinpath('old')
+    recording_directory.mkdir(parents=True)
+    assert jobs.ProcessingJob.load(config, recording_directory) is None
+
+    recording_directory.joinpath(config.config['video0']['temp_video_file']).touch()
+    job = jobs.ProcessingJob.load(config, recording_directory)
+    assert job.job_name == 'old' and not job.queued
+    assert read_journal(job)[0]['event'] == 'created'
+
+def test_load_jobs_resumes_unfinished_jobs(config, submitted):
+    not_queued = make_job(config, 'not queued', created=1.0)
+    queued = make_job(config, 'queued', created=2.0)
+    queued.record('queued')
+    finished = make_job(config, 'finished', created=3.0)
+    finished.record('queued')
+    finished.record('finished')
+
+    job_manager = jobs.JobManager(config, None)
+    assert sorted(job.job_name for job in job_manager.processing_jobs) == ['finished', 'not queued', 'queued']
+    assert [job.job_name for job in submitted(job_manager)] == ['queued']
+    # Resuming doesn't queue the job again
+    assert [entry['event'] for entry in read_journal(queued)] == ['created', 'queued']
+
+def test_failed_jobs_are_not_resumed(config, submitted):
+    job = make_job(config)
+    job.record('queued')
+    job.record('failed', error='corrupt recording')
+
+    job_manager = jobs.JobManager(config, None)
+    loaded = job_manager.processing_jobs[0]
+    assert submitted(job_manager) == []
+    assert loaded.failed and not loaded.started
+    assert loaded.get_progress_message() == 'Failed: corrupt recording'
+
+    # Running it again queues it again, so it is resumed after the next restart
+    job_manager.run_job('lecture')
+    assert submitted(job_manager) == [loaded]
+    assert read_journal(job)[-1]['event'] == 'queued'
+    assert not jobs.ProcessingJob.load(config, job.recording_directory).failed
+
+def test_scheduler_journals_failed_jobs(config):
+    job = make_job(config)
+    def process():
+        raise Exception('corrupt recording')
+    job.process = process
+
+    scheduler = jobs.JobScheduler(config)
+    scheduler.submit(job)
+    deadline = time.time() + 5
+    while read_journal(job)[-1]['event'] != 'failed' and time.time() < deadline:
+        time.sleep(0.01)
+
+    assert job.failed and not job.started
+    assert job.progress_message == 'Failed: corrupt recording'
+    assert read_journal(job)[-1]['event'] == 'failed'
+    assert read_journal(job)[-1]['error'] == 'corrupt recording'
+
+def test_progress_of_a_job(config, monkeypatch):
+    job = make_job(config)
+    assert job.get_progress()['stage'] is None
+
+    video_processing = job.video_processing
+    now = time.time()
+    video_processing.frames_total = {'video0': 300, 'video1': 300}
+    video_processing.frames_processed = {'video0': 100, 'video1': 50}
+    video_processing.processing_start_times = {'video0': now - 10, 'video1': now - 10}
+    job.stage_start_time = now - 12
+    job.stage = 'process_recording'
+    job.stage_times = {'copy_output': 0.5}
+
+    monkeypatch.setattr(time, 'time', lambda: now) # stops the clock for jobs and processing
+    progress = job.get_progress()
+    assert progress['stage'] == 'process_recording'
+    assert progress['stage_times'] == {'copy_output': 0.5, 'process_recording': 12}
+    assert progress['video_devices']['video0'] == {'frames_processed': 100, 'frames_total': 300, 'fps': 10}
+    assert progress['fps'] == 15
+    # The slower camera decides when processing finishes
+    assert progress['eta'] == 50
+    assert video_processing.get_progress() == 0.25
+
+def test_progress_without_speed_has_no_eta(config):
+    video_processing = make_job(config).video_processing
+    video_processing.frames_total = {'video0': 300}
+    assert video_processing.get_progress_details()['eta'] is None
+    assert video_processing.get_progress() == 0
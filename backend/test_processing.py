@@ -0,0 +1,199 @@
+import subprocess
+import threading
+import cv2
+import numpy as np
+import pytest
+import processing
+
+CORNERS = [[100, 50], [1200, 80], [60, 700], [1250, 650]]
+
+def get_board_frame(width: int = 1280, height: int = 720) -> np.ndarray:
+    """Returns a frame with a pattern that shows any difference in where pixels are sampled from"""
+    xs, ys = np.meshgrid(np.arange(width), np.arange(height))
+    frame = np.stack([xs % 256, ys % 256, (xs * ys) % 251], axis=-1).astype(np.uint8)
+    return cv2.GaussianBlur(frame, (5, 5), 0)
+
+@pytest.mark.parametrize('output_size', [(640, 360), (1920, 1080)])
+def test_remap_matches_warp_perspective(config, output_size):
+    video_processing = processing.Processing(config, None)
+    transform_matrix = video_processing.get_warp_matrix(corners=CORNERS, output_size=output_size)
+    frame = get_board_frame()
+
+    remapped = processing.Warper(transform_matrix, output_size, 'remap').warp(frame)
+    warped = processing.Warper(transform_matrix, output_size, 'perspective').warp(frame)
+
+    assert remapped.shape == warped.shape == (output_size[1], output_size[0], 3)
+    # The fixed-point remap tables round the sample positions slightly differently
+    difference = cv2.absdiff(remapped, warped)
+    assert difference.mean() < 1
+    assert np.percentile(difference, 99) <= 8
+
+def test_warp_matrix_maps_corners_to_output_corners(config):
+    video_processing = processing.Processing(config, None)
+    transform_matrix = video_processing.get_warp_matrix(corners=CORNERS, output_size=(1920, 1080))
+    mapped = cv2.perspectiveTransform(np.array([CORNERS], dtype=np.float32), transform_matrix)[0]
+    np.testing.assert_allclose(mapped, [[0, 0], [1920, 0], [0, 1080], [1920, 1080]], atol=1e-2)
+
+def test_warp_stream_repeats_last_frame_for_skipped_frames():
+    warper = processing.Warper(np.eye(3), (8, 8), 'perspective')
+    frame = np.full((8, 8, 3), 7, np.uint8)
+    warped = list(warper.warp_stream([frame, None, None]))
+    assert len(warped) == 3
+    assert warped[1] is warped[0] and warped[2] is warped[0]
+
+def test_get_warper_is_shared_until_the_corners_change(config):
+    config.config['video0']['corners'] = CORNERS
+    video_processing = processing.Processing(config, None)
+    warper = video_processing.get_warper('video0', (640, 360))
+    assert video_processing.get_warper('video0', (640, 360)) is warper
+
+    config.config['video0']['corners'] = [[corner[0] + 1, corner[1]] for corner in CORNERS]
+    assert video_processing.get_warper('video0', (640, 360)) is not warper
+
+def test_clear_warper_cache(config):
+    config.config['video0']['corners'] = CORNERS
+    video_processing = processing.Processing(config, None)
+    warper = video_processing.get_warper('video0', (640, 360))
+    processing.clear_warper_cache('video1')
+    assert video_processing.get_warper('video0', (640, 360)) is warper
+    processing.clear_warper_cache('video0')
+    assert video_processing.get_warper('video0', (640, 360)) is not warper
+
+@pytest.fixture
+def numbered_video(tmp_path):
+    """A lossless 10 fps video of 20 frames, where each frame is filled with ten times its index"""
+    video_file = tmp_path.joinpath('numbered.mkv')
+    writer = cv2.VideoWriter(str(video_file), cv2.VideoWriter_fourcc(*'FFV1'), 10, (32, 16))
+    for i in range(20):
+        writer.write(np.full((16, 32, 3), i * 10, np.uint8))
+    writer.release()
+    return video_file
+
+def read_frame_numbers(video_file, output_fps: float, start_index: int = 0, end_index: int = None) -> list[int]:
+    video = cv2.VideoCapture(str(video_file))
+    try:
+        return [int(frame.mean()) // 10 for frame in processing.read_frames(video, output_fps, start_index, end_index)]
+    finally:
+        video.release()
+
+def test_read_frames_at_the_video_framerate(numbered_video):
+    assert read_frame_numbers(numbered_video, 10) == list(range(20))
+
+def test_read_frames_range(numbered_video):
+    assert read_frame_numbers(numbered_video, 10, 5, 12) == list(range(5, 12))
+    assert read_frame_numbers(numbered_video, 10, 15, 100) == list(range(15, 20))
+
+def test_read_frames_repeats_and_drops_frames_to_match_the_output_framerate(numbered_video):
+    assert read_frame_numbers(numbered_video, 20) == [i // 2 for i in range(40)]
+    assert read_frame_numbers(numbered_video, 20, 5, 11) == [2, 3, 3, 4, 4, 5]
+    assert read_frame_numbers(numbered_video, 5) == list(range(0, 20, 2))
+
+@pytest.mark.parametrize('output_fps', [10, 20, 5])
+def test_read_frames_segments_join_up(numbered_video, output_fps):
+    # The segmented pipeline reads each time segment on its own and joins them
+    full = read_frame_numbers(numbered_video, output_fps)
+    boundaries = [0, 7, 13, len(full)]
+    segments = [read_frame_numbers(numbered_video, output_fps, start, end) for start, end in zip(boundaries, boundaries[1:])]
+    assert sum(segments, []) == full
+
+def get_whiteboard(width: int = 1280, height: int = 720) -> np.ndarray:
+    return np.full((height, width, 3), 230, np.uint8)
+
+def test_region_difference_notices_new_writing_the_frame_mean_hides():
+    board = get_whiteboard()
+    written = board.copy()
+    cv2.putText(written, 'x', (600, 360), cv2.FONT_HERSHEY_SIMPLEX, 1, (20, 20, 20), 3)
+
+    thumbnail, written_thumbnail = processing.get_thumbnail(board), processing.get_thumbnail(written)
+    assert processing.frame_difference(thumbnail, written_thumbnail) < 1
+    assert processing.region_difference(thumbnail, written_thumbnail) > 1
+    assert processing.region_difference(thumbnail, thumbnail) == 0
+
+def test_skip_unchanged_frames():
+    board = get_whiteboard()
+    noisy = board.copy()
+    noisy[::50, ::50] = 235 # sensor noise
+    written = board.copy()
+    cv2.line(written, (100, 100), (300, 120), (20, 20, 20), 4)
+
+    frames = list(processing.skip_unchanged_frames([board, noisy, None, written, written.copy()], 1.0))
+    assert frames[0] is board
+    assert frames[1] is None
+    assert frames[2] is None
+    assert frames[3] is written
+    assert frames[4] is None
+
+def test_skip_unchanged_frames_compares_against_the_last_changed_frame():
+    # A slow fade never changes much between two frames, but adds up against the last frame that was warped
+    frames = [np.full((72, 128, 3), 100 + i, np.uint8) for i in range(6)]
+    kept = [frame is not None for frame in processing.skip_unchanged_frames(frames, 2.5)]
+    assert kept == [True, False, False, True, False, False]
+
+@pytest.mark.parametrize('codec, codec_args', [
+    ('aac', ['-codec:a', 'copy']),
+    ('mp3', ['-codec:a', 'copy']),
+    ('pcm_s16le', ['-codec:a', 'aac']), # mp4 can't hold raw audio
+    ('', ['-codec:a', 'aac']), # no audio stream, or the file couldn't be read
+])
+def test_get_audio_codec_args(monkeypatch, codec, codec_args):
+    commands = []
+    def run(command, **kwargs):
+        commands.append(command)
+        return subprocess.CompletedProcess(command, 0, stdout=f"{codec}\n".encode('utf-8'), stderr=b'')
+    monkeypatch.setattr(processing.subprocess, 'run', run)
+
+    assert processing.get_audio_codec_args('temp_video0.mkv') == codec_args
+    assert commands[0][0] == 'ffprobe' and commands[0][-1] == 'temp_video0.mkv'
+
+def test_get_audio_codec_args_without_ffprobe(monkeypatch):
+    def run(command, **kwargs):
+        raise FileNotFoundError(command[0])
+    monkeypatch.setattr(processing.subprocess, 'run', run)
+    assert processing.get_audio_codec_args('temp_video0.mkv') == ['-codec:a', 'aac']
+
+def test_get_incremental_parts(config, tmp_path):
+    video_processing = processing.Processing(config, tmp_path)
+    assert video_processing.get_incremental_parts() == []
+
+    incremental_directory = tmp_path.joinpath('incremental')
+    incremental_directory.mkdir()
+    for name in ['part_0_50', 'part_50_100', 'part_100_150', 'part_150_200', 'part_300_350']:
+        incremental_directory.joinpath(f"{name}.mp4").touch()
+    for name in ['part_0_50', 'part_50_100', 'part_150_200', 'part_300_350']:
+        incremental_directory.joinpath(f"{name}.done").touch()
+
+    # part_100_150 was given up before it was done, so the parts after it don't line up yet
+    assert video_processing.get_incremental_parts() == [(0, 50, incremental_directory.joinpath('part_0_50.mp4')),
+                                                        (50, 100, incremental_directory.joinpath('part_50_100.mp4'))]
+
+def test_process_finished_segments_waits_for_the_first_segment(config, tmp_path):
+    video_processing = processing.Processing(config, tmp_path)
+    assert not video_processing.process_finished_segments(10)
+
+    recording_file = tmp_path.joinpath(config.config['video0']['temp_video_file'])
+    processing.get_segment_manifest(recording_file).write_text('')
+    assert not video_processing.process_finished_segments(10)
+    assert not tmp_path.joinpath('incremental').exists()
+
+def test_count_frames_gives_up_once_cancelled(config):
+    video_processing = processing.Processing(config, None)
+    video_processing.cancelled = threading.Event()
+    frames = video_processing.count_frames(iter(range(10)), 'video0')
+    assert [next(frames), next(frames)] == [0, 1]
+
+    video_processing.cancelled.set()
+    with pytest.raises(Exception, match='cancelled'):
+        next(frames)
+    assert video_processing.frames_processed['video0'] == 2
+
+def test_get_video_codec_args(config):
+    assert processing.get_video_codec_args(config) == ['-codec:v', 'libx264', '-preset', 'medium', '-crf', '26', '-tune', 'stillimage',
+                                                       '-g', '300', '-pix_fmt', 'yuv420p']
+    assert processing.get_video_codec_args(config, 'small') == ['-codec:v', 'libx265', '-preset', 'medium', '-crf', '30', '-g', '600',
+                                                                '-pix_fmt', 'yuv420p']
+
+def test_get_video_codec_args_overrides_the_profile(config):
+    config.config['encoding'].update({'profile': 'fast', 'crf': 20, 'tune': '', 'threads': 2})
+    # A blank tune in the config keeps the profile's
+    assert processing.get_video_codec_args(config) == ['-codec:v', 'libx264', '-preset', 'veryfast', '-crf', '20', '-tune', 'stillimage',
+                                                       '-g', '300', '-threads', '2', '-pix_fmt', 'yuv420p']
@@ -0,0 +1,150 @@
+import pathlib
+import shutil
+import subprocess
+import sys
+import time
+import cv2
+import pytest
+import processing
+import recorder
+
+def test_segment_files():
+    recording_file = pathlib.Path('recordings/lecture/temp_video0.mkv')
+    assert processing.get_segment_pattern(recording_file) == pathlib.Path('recordings/lecture/temp_video0_%05d.mkv')
+    assert processing.get_segment_manifest(recording_file) == pathlib.Path('recordings/lecture/temp_video0.csv')
+
+def test_read_segment_manifest_skips_a_line_cut_off_by_a_crash(tmp_path):
+    manifest_file = tmp_path.joinpath('temp_video0.csv')
+    manifest_file.write_text('temp_video0_00000.mkv,0.000000,10.010000\ntemp_video0_00001.mkv,10.010000,20.000000\ntemp_video0_00002.mkv,20.0')
+    assert processing.read_segment_manifest(manifest_file) == [('temp_video0_00000.mkv', 0.0, 10.01), ('temp_video0_00001.mkv', 10.01, 20.0)]
+
+def test_write_segment_concat_list(tmp_path):
+    recording_file = tmp_path.joinpath('temp_video0.mkv')
+    processing.get_segment_manifest(recording_file).write_text('temp_video0_00000.mkv,0.000000,10.010000\ntemp_video0_00001.mkv,10.010000,14.5\n')
+
+    concat_list_file = processing.write_segment_concat_list(recording_file)
+    assert concat_list_file == tmp_path.joinpath('temp_video0.ffconcat')
+    assert concat_list_file.read_text() == ("ffconcat version 1.0\n"
+                                            "file 'temp_video0_00000.mkv'\nduration 10.01\n"
+                                            "file 'temp_video0_00001.mkv'\nduration 4.49\n")
+
+def test_get_recording_file(config, tmp_path):
+    video_processing = processing.Processing(config, tmp_path)
+    recording_file = tmp_path.joinpath(config.config['video0']['temp_video_file'])
+    assert video_processing.get_recording_file('video0') == recording_file.as_posix()
+
+    processing.get_segment_manifest(recording_file).write_text('temp_video0_00000.mkv,0.000000,1.000000\n')
+    assert video_processing.get_recording_file('video0') == recording_file.with_suffix('.ffconcat').as_posix()
+    assert recording_file.with_suffix('.ffconcat').exists()
+
+def test_get_output_args(config, tmp_path):
+    video_recorder = recorder.VideoRecorder(config)
+    recording_file = tmp_path.joinpath(config.config['video0']['temp_video_file'])
+    assert video_recorder.get_output_args('video0', tmp_path) == ['-codec:a', 'aac', recording_file]
+
+    config.config['recording']['segment_length'] = 10
+    output_args = video_recorder.get_output_args('video0', tmp_path)
+    # Segments can only be cut on keyframes, so one is forced at every cut
+    assert output_args[output_args.index('-force_key_frames') + 1] == 'expr:gte(t,n_forced*10)'
+    assert output_args[output_args.index('-segment_time') + 1] == '10'
+    assert output_args[output_args.index('-segment_list') + 1] == processing.get_segment_manifest(recording_file)
+    assert output_args[-1] == processing.get_segment_pattern(recording_file)
+
+    # A stream copy can't add keyframes
+    config.config['video0']['streamcopy'] = True
+    output_args = video_recorder.get_output_args('video0', tmp_path)
+    assert output_args[:4] == ['-codec:v', 'copy', '-codec:a', 'copy']
+    assert '-force_key_frames' not in output_args
+
+def test_clear_files_of_a_segmented_recording(config, tmp_path):
+    config.config['video1']['enabled'] = True
+    files = []
+    for video_device in ['video0', 'video1']:
+        recording_file = tmp_path.joinpath(config.config[video_device]['temp_video_file'])
+        files.extend(tmp_path.joinpath(str(processing.get_segment_pattern(recording_file).name) % i) for i in range(3))
+        files.extend([processing.get_segment_manifest(recording_file), recording_file.with_suffix('.ffconcat')])
+    files.append(tmp_path.joinpath(config.config['files']['output_video_file']))
+    for file in files:
+        file.touch()
+    kept_file = tmp_path.joinpath('job.jsonl')
+    kept_file.touch()
+
+    recorder.VideoRecorder(config).clear_files(tmp_path)
+    assert [file for file in files if file.exists()] == []
+    assert kept_file.exists()
+
+@pytest.mark.skipif(shutil.which('ffmpeg') is None, reason='needs ffmpeg')
+def test_segmented_recording_reads_as_one_video(config, tmp_path):
+    # Record a test pattern the way a camera is recorded, then read it back through the concat list
+    config.config['recording']['segment_length'] = 1
+    recording_file = tmp_path.joinpath(config.config['video0']['temp_video_file'])
+    output_args = recorder.VideoRecorder(config).get_output_args('video0', tmp_path)
+    subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y', '-f', 'lavfi', '-i', 'testsrc=size=160x120:rate=10', '-t', '3.5',
+                    '-codec:v', 'libx264', '-preset', 'ultrafast', *[str(arg) for arg in output_args]], check=True)
+
+    segments = processing.read_segment_manifest(processing.get_segment_manifest(recording_file))
+    assert [round(end - start, 2) for name, start, end in segments] == [1, 1, 1, 0.5]
+
+    video = cv2.VideoCapture(processing.Processing(config, tmp_path).get_recording_file('video0'))
+    frame_count = 0
+    while video.read()[0]:
+        frame_count += 1
+    video.release()
+    assert frame_count == 35
+
+# Stands in for an ffmpeg recording: writes progress lines ending in carriage returns like ffmpeg does,
+# then waits for the q that stops it
+FAKE_FFMPEG = r'''
+import sys
+sys.stderr.write("Input #0, v4l2, from '/dev/video0':\n")
+sys.stderr.write("frame=  10 fps= 29 q=-1.0 size=    256KiB time=00:00:00.33 dup=0 drop=0 speed=   1x\r")
+sys.stderr.write("frame= 300 fps= 30 q=-1.0 size=   2048KiB time=00:00:10.00 bitrate=1677.7kbits/s dup=1 drop=3 speed=   1x\r")
+sys.stderr.flush()
+if sys.stdin.read(1) != 'q':
+    sys.exit(1)
+'''
+
+def wait_for(condition, timeout: float = 5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+
+def test_recording_process_health():
+    recording_process = recorder.RecordingProcess([sys.executable, '-c', FAKE_FFMPEG], ['video0'])
+    wait_for(lambda: recording_process.progress.get('frame') == '300')
+    health = recording_process.get_health()
+    assert health['running'] and health['healthy']
+    assert (health['frames'], health['fps'], health['dropped_frames'], health['duplicated_frames']) == (300, 30, 3, 1)
+    assert health['speed'] == '1x'
+    assert health['log'] == ["Input #0, v4l2, from '/dev/video0':"]
+
+    recording_process.stop(5)
+    health = recording_process.get_health()
+    assert not health['running'] and health['returncode'] == 0
+
+def test_recording_process_is_terminated_when_it_doesnt_stop():
+    recording_process = recorder.RecordingProcess([sys.executable, '-c', 'import time; time.sleep(60)'], ['video0'])
+    start_time = time.time()
+    recording_process.stop(0.5)
+    assert time.time() - start_time < 5
+    assert recording_process.process.returncode not in [None, 0]
+    assert not recording_process.get_health()['healthy']
+
+def test_recording_process_before_the_first_frame():
+    recording_process = recorder.RecordingProcess([sys.executable, '-c', 'import sys; sys.stdin.read(1)'], ['video0', 'video1'])
+    health = recording_process.get_health()
+    assert health['video_devices'] == ['video0', 'video1']
+    assert health['frames'] == 0 and health['speed'] == 'N/A'
+    recording_process.stop(5)
+
+def test_stop_recording_stops_every_process_at_the_same_time(config):
+    config.config['recording']['stop_timeout'] = 1
+    config.config['end_recording_delay'] = 0.5
+    video_recorder = recorder.VideoRecorder(config)
+    video_recorder.recording_processes = [recorder.RecordingProcess([sys.executable, '-c', 'import time; time.sleep(60)'], [video_device])
+                                          for video_device in ['video0', 'video1']]
+    start_time = time.time()
+    video_recorder.stop_recording()
+    # Both are terminated after the one stop timeout, rather than one after the other
+    assert 1 <= time.time() - start_time < 1.9
+    assert video_recorder.recording_processes == []